@@ -1,12 +1,25 @@
 webconfig = {
     'interface' : '0.0.0.0',
     'port' : 80,
-    'googlekey' : 'KEY'
+    'googlekey' : 'KEY',
+    'debug' : False,
+    'threads' : 4, # Requests served at once
+    'streams' : 8, # Streamed requests, such as /live, served at once on their own threads
+    'request_timeout' : 30, # Seconds a client can take to send a request or receive each part of a response
+    'nice' : 10, # Lower web server CPU priority below the tracker
+    'devices' : {}, # Device name to log directory for each tracker served. Empty serves this tracker's logs
+    'index_workers' : 2, # Processes reading logs to update the device indexes
+    'index_rescan_secs' : 300, # Longest time before every log is checked for changes
+    'page_logs' : 48 # Logs on each page of the log grid
 }
 appconfig = {
     'logdir' : '/home/pi/tracker',
     'prefix' : 'gpslog',
-    'debug' : True,
+    'trace_size' : 2000, # Trace events held in memory, see trackertrace.py
+    'trace_level' : 'info', # Lowest level kept for categories not in trace_levels
+    'trace_levels' : {}, # Level by category, e.g. {'distance': 'debug'}
+    'trace_print' : 'info', # Events at or above this level are printed too
+    'trace_signal' : 'SIGUSR1', # Prints the held trace
     'font' : '/usr/share/fonts/truetype/freefont/FreeSans.ttf',
     'battsensor' : 0x36,
     'tempsensor' : 0x48,
@@ -15,7 +28,32 @@ appconfig = {
     'gpio_run_pin' : 13,
     'gpio_run_indicator' : 19,
     'gpio_pwr_pin' : 4,
-    'gpio_pwr_indicator' : 5
+    'gpio_pwr_indicator' : 5,
+    'sysinfo_refresh' : 30,
+    'split_minutes' : 60,
+    'split_climb_metres' : 100,
+    'distance' : 'haversine', # haversine, fast or vincenty, see trackerdistance.py
+    'archive_age' : 7200,
+    'archive_block_size' : 65536,
+    'thumbdir' : '/home/pi/tracker/thumbs',
+    'thumb_size' : (160, 120),
+    'thumb_workers' : 2,
+    'live_socket' : '/tmp/gpstracker.live',
+    'live_buffer' : 50, # Fixes held for each slow web client
+    'live_clients' : 8,
+    'status_file' : '/dev/shm/gpstracker.status',
+    'gpsd_client' : 'gps', # gps module or 'raw' for the minimal client in trackergpsd.py
+    'gpsd_host' : '127.0.0.1',
+    'gpsd_port' : 2947,
+    'gpsd_timeout' : 10, # seconds without a report before reconnecting
+    'gpsd_backoff' : (1, 60), # first and longest wait between connection attempts
+    'duty_cycle' : True, # Rest the GPS whilst stationary
+    'stationary_secs' : 300, # Time within stationary_metres before resting
+    'stationary_metres' : 30,
+    'rest_secs' : 120, # Time the GPS rests between checks for movement
+    'lowpower_rest_secs' : 600, # Rest time whilst on the Low power screen
+    'acquire_secs' : 60, # Longest wait for a fix after resting
+    'checkpoint_records' : 30 # Log records between saving the day's summary
 }
 
 
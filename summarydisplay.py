@@ -33,30 +33,36 @@ class Tracker1SubScreen(BasicScreen):
         self.fontsize = 20
         self.indent = 10
         self.showmetric = True
+
+    def drawbackground(self):
+        line = 0
+        if self.showmetric:
+            self.writeLabel('km: ', self.indent, line, self.fontsize, 'distance')
+        else:
+            self.writeLabel('Miles: ', self.indent, line, self.fontsize, 'distance')
+        line += self.fontsize
+        for (label, field) in [('Total time: ', 'time'), ('Sessions: ', 'sessions'), ('Max Height: ', 'max'), ('Min Height: ', 'min')]:
+            self.writeLabel(label, self.indent, line, self.fontsize, field)
+            line += self.fontsize
         
     def draw(self):
-        line = 0
-        self.clearScreen(1)
+        self.layout()
         if self.gps is None:
             raise DisplayError("No GPS object configured")
 
         if self.showmetric:
-            self.writeText('km: {0:.2f}'.format(self.gps.data.km),self.indent,line,self.fontsize)
+            self.setField('distance', '{0:.2f}'.format(self.gps.data.km))
         else:
-            self.writeText('Miles: {0:.2f}'.format(self.gps.data.mile),self.indent,line,self.fontsize)
+            self.setField('distance', '{0:.2f}'.format(self.gps.data.mile))
 
-        line += self.fontsize
         if self.gps.data.sessions_recorded >= 1:
             (h,m,s) = hms(self.gps.data.secs)
-            self.writeText('Total time: {0:02d}h {1:02d}m {2:02d}s'.format(h,m,s),self.indent,line,self.fontsize)
+            self.setField('time', '{0:02d}h {1:02d}m {2:02d}s'.format(h,m,s))
         else:
-            self.writeText('Total time: No log',self.indent,line,self.fontsize)
-        line += self.fontsize
-        self.writeText('Sessions: {0}'.format(self.gps.data.sessions_recorded),self.indent,line,self.fontsize)
-        line += self.fontsize
-        self.writeText('Max Height: {0}m'.format(self.gps.data.max_height),self.indent,line,self.fontsize)
-        line += self.fontsize
-        self.writeText('Min Height: {0}m'.format(self.gps.data.min_height),self.indent,line,self.fontsize)
+            self.setField('time', 'No log')
+        self.setField('sessions', '{0}'.format(self.gps.data.sessions_recorded))
+        self.setField('max', '{0}m'.format(self.gps.data.max_height))
+        self.setField('min', '{0}m'.format(self.gps.data.min_height))
             
 class Tracker2SubScreen(BasicScreen):
     def __init__(self):
@@ -65,41 +71,50 @@ class Tracker2SubScreen(BasicScreen):
         self.fontsize = 20
         self.indent = 10
         self.showmetric = True
+        self.lines = 6 # 5 splits and the fastest
+
+    def drawbackground(self):
+        line = 0
+        if self.showmetric:
+            self.writeText('Split time per km:',self.indent,line,self.fontsize)
+        else:
+            self.writeText('Split time per mile:',self.indent,line,self.fontsize)
+        for i in range(self.lines):
+            line += self.fontsize
+            self.addField(i, self.indent, line, self.fontsize)
 
     def draw(self):
         line = 0
-        records = 0
-        split_time_array = None
+        splits = None
         unittext = 'km'
-        self.clearScreen(1)
+        self.layout()
         if self.gps is None:
             raise DisplayError("No GPS object configured")
 
         summary = self.gps.data
 
         if self.showmetric:
-            self.writeText('Split time per km:',self.indent,line,self.fontsize)
-            records = len(summary.split_time_km)
-            split_time_array = summary.split_time_km
+            splits = summary.split_time_km
         else:
-            self.writeText('Split time per mile:',self.indent,line,self.fontsize)
-            records = len(summary.split_time_miles)
-            split_time_array = summary.split_time_miles
+            splits = summary.split_time_miles
             unittext = 'Mile'
             
-        line += self.fontsize
-
         # Last entry is the current km/mile so will not be completely calculated
-        # Write the last 5 entries
-    
-        for i in reversed(split_time_array[-6:-1]):
-            hour = i / 3600
-            minute = (i - (hour * 3600)) / 60
-            second = i - (hour * 3600) - (minute * 60)
-            #print ("idx: {0}, h:{1}, m{2}, s{3}".format(i, hour, minute, second))
-            self.writeText('{4} {0}: {1:02d}h:{2:02d}m:{3:02d}s'.format(records-1, hour, minute, second,unittext),self.indent,line,self.fontsize)
-            line += self.fontsize
-            records -= 1
+        # Write the last 5 completed entries
+        for (i, secs) in splits.last(5):
+            (hour, minute, second) = hms(secs)
+            self.setField(line, '{4} {0}: {1:02d}h:{2:02d}m:{3:02d}s'.format(i + 1, hour, minute, second,unittext))
+            line += 1
+
+        fastest = splits.fastest()
+        if fastest is not None:
+            (hour, minute, second) = hms(fastest[1])
+            self.setField(line, 'Best {0}: {1:02d}h:{2:02d}m:{3:02d}s'.format(fastest[0] + 1, hour, minute, second))
+            line += 1
+
+        # Blank any lines no longer used
+        for i in range(line, self.lines):
+            self.setField(i, '')
 
 class Tracker3SubScreen(BasicScreen):
     'Show miles/km per hour summary'
@@ -110,41 +125,58 @@ class Tracker3SubScreen(BasicScreen):
         self.fontsize = 20
         self.indent = 10
         self.showmetric = True
+        self.lines = 6 # Estimate and 5 periods
+
+    def drawbackground(self):
+        # Heading depends on the split period so is a field
+        self.addField('heading', self.indent, 0, self.fontsize)
+        for i in range(self.lines):
+            self.addField(i, self.indent, (i + 1) * self.fontsize, self.fontsize)
 
     def draw(self):
         line = 0
         split_time_array = None
         unittext = 'km'
-        self.clearScreen(1)
+        self.layout()
         if self.gps is None:
             raise DisplayError("No GPS object configured")
 
         summary = self.gps.data
-        distance = 0
 
         if self.showmetric:
-            self.writeText('km per hour:',self.indent,line,self.fontsize)
-            split_time_array = summary.split_km_hour
+            headtext = 'km'
+            splits = summary.split_km_hour
         else:
-            self.writeText('Miles per hour:',self.indent,line,self.fontsize)
-            split_time_array = summary.split_mile_hour
+            headtext = 'Miles'
+            splits = summary.split_mile_hour
             unittext = 'miles'
+
+        # Splits are usually an hour but can be configured in minutes
+        if splits.size == 3600:
+            periodtext = 'Hour'
+            self.setField('heading', '{0} per hour:'.format(headtext))
+        else:
+            periodtext = '{0:.0f}min'.format(splits.size / 60)
+            self.setField('heading', '{0} per {1}:'.format(headtext, periodtext))
             
-        line += self.fontsize
-        records = len(split_time_array)
+        records = len(splits)
 
-        # Last entry is the current km/mile so will not be completely calculated
+        # Last entry is the current period so will not be completely calculated
         # Write the last 5 entries and estimate the last projected speed
-        if (records * 3600) > self.gps.data.secs:
+        partial = summary.secs - ((records-1) * splits.size)
+        if records > 0 and partial > 0:
             # last record is partial. Very rare chance that this wouldn't be the case
-            unitperhour = split_time_array[-1:][0] / ((self.gps.data.secs - ((records-1) * 3600)) / 3600)
-            self.writeText('Hour {0}: est {1:.2f} {2}'.format(records, unitperhour, unittext),self.indent,line,self.fontsize)
-            line += self.fontsize
+            unitperhour = splits.current() / (partial / 3600.0)
+            self.setField(line, '{0} {1}: est {2:.2f} {3}'.format(periodtext, records, unitperhour, unittext))
+            line += 1
             
-        for i in reversed(split_time_array[-6:-1]):
-            self.writeText('Hour {0}: {1:.2f} {2}'.format(records-1, i, unittext),self.indent,line,self.fontsize)
-            line += self.fontsize
-            records -= 1
+        for (i, distance) in splits.last(5):
+            self.setField(line, '{0} {1}: {2:.2f} {3}'.format(periodtext, i + 1, distance, unittext))
+            line += 1
+
+        # Blank any lines no longer used
+        for i in range(line, self.lines):
+            self.setField(i, '')
 
 
 class SummaryScreen(StatusContainer):
@@ -156,7 +188,7 @@ class SummaryScreen(StatusContainer):
         # Override and define slower refresh
         # times for the summary screen
         self.partial_refresh_time = 15
-        self.full_refresh_time = 300
+        self.partial_budget = 20
         
         self.trackerinfo1 = Tracker1SubScreen()
         self.subscreens.registerScreen(self.trackerinfo1)
@@ -173,6 +205,9 @@ class SummaryScreen(StatusContainer):
         self.trackerinfo1.showmetric = gometric
         self.trackerinfo2.showmetric = gometric
         self.trackerinfo3.showmetric = gometric
+        # Unit labels are part of the backgrounds
+        self.trackerinfo1.discardbackground()
+        self.trackerinfo2.discardbackground()
             
     def set_gps(self, obj):
         self.gps = obj
@@ -12,20 +12,42 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from trackerdisplay import Screens
+# Run with --profile-startup to print the time taken by each step of starting.
+# Imports are marked individually as they make up much of the start up time
+from trackerprofile import timeline
+from trackerdisplay import Screens, RenderThread
+timeline.mark('import trackerdisplay (PIL, papirus)')
 from trackercontext import *
+timeline.mark('import trackercontext')
 from summarydisplay import SummaryScreen
+timeline.mark('import summarydisplay')
 from trackergpio import IndicatorButton
+timeline.mark('import trackergpio (RPi.GPIO)')
 import smbus
+timeline.mark('import smbus')
 import time
+from threading import Thread, Lock
 from trackergps import TrackerGPS
+timeline.mark('import trackergps (gps, dateutil)')
+from trackerlog import LogArchiver
+from trackerindex import LogIndex
+from trackerlive import LivePublisher
+from trackerstatus import StatusWriter
 import subprocess
 from config import appconfig
+from trackertrace import trace
+timeline.mark('import remaining modules')
+
+apptrace = trace.category('tracker')
 
 class trackerapp(object):
 
     def __init__(self):
         self.tracker_screens = Screens()
+        # Screens are drawn on their own thread so buttons are always serviced
+        self.renderer = RenderThread()
+        self.tracker_screens.renderer = self.renderer
+        timeline.mark('create display')
         self.runbtn = IndicatorButton(appconfig['gpio_run_pin'],appconfig['gpio_run_indicator'])
         self.runbtn.rise_fn = self.run_btn_up
         self.runbtn.fall_fn = self.run_btn_dn
@@ -35,6 +57,15 @@ class trackerapp(object):
         self.pwrbtn.fall_fn = self.pwr_btn_dn
 
         self.gps = None
+        self.loader = None # Thread replaying today's log
+        self.loaderlock = Lock()
+        self.loaded = False # Today's log has been replayed
+        self.start_when_loaded = False # Run pressed before the log was replayed
+        self.archiver = LogArchiver()
+        # Closed logs are added to the index used by the web statistics
+        self.archiver.onarchive = LogIndex(appconfig['logdir']).refresh
+        self.status = None
+        self.battery_period = 60 # seconds between publishing battery status
         self.gps_running = False
         self.run_held = False
         self.pwr_held = False
@@ -45,7 +76,7 @@ class trackerapp(object):
             # Do other things
         else:
             # Brief press
-            self.tracker_screens.nextScreen()
+            self.renderer.change(self.tracker_screens.nextScreen)
         pass
 
     def pwr_btn_dn(self, channel):
@@ -57,29 +88,61 @@ class trackerapp(object):
     def run_btn_up(self, channel):
         if self.run_held:
             self.run_held = False
-            if self.gps_running:
-                print ("Stopping GPS")
-                self.gps.stop()
-                self.gps.log_gps(False)
-            else:
-                print ("Running GPS")
-                self.gps.start()
-                self.gps.log_gps(True)
-            self.gps_running = not self.gps_running
+            # The summary must include today's log before logging adds to
+            # it. The loader starts the GPS if run is pressed before then
+            self.loaderlock.acquire()
+            try:
+                if self.gps_running:
+                    apptrace.info("Stopping GPS")
+                    if self.start_when_loaded:
+                        self.start_when_loaded = False
+                    else:
+                        self.stopgps()
+                elif self.loaded:
+                    apptrace.info("Running GPS")
+                    self.startgps()
+                else:
+                    apptrace.info("Running GPS once today's log is loaded")
+                    self.start_when_loaded = True
+                self.gps_running = not self.gps_running
+            finally:
+                self.loaderlock.release()
             self.tracker_screens.currentScreen().invalidate()
         else:
             # Brief press
-            if self.tracker_screens.currentScreen().name == 'Main' or self.tracker_screens.currentScreen().name == 'Activity':
-                self.tracker_screens.currentScreen().subscreens.nextScreen()
-                self.tracker_screens.currentScreen().invalidate()
+            self.renderer.change(self.nextsubscreen)
             pass
+
+    def nextsubscreen(self):
+        if self.tracker_screens.currentScreen().name == 'Main' or self.tracker_screens.currentScreen().name == 'Activity':
+            self.tracker_screens.currentScreen().subscreens.nextScreen()
+            self.tracker_screens.currentScreen().invalidate()
         
     def run(self):
 
         try:
+            trace.dumponsignal() # kill -USR1 prints what the tracker has been doing
+            self.renderer.start()
+            # Show something as soon as possible. Everything else
+            # is set up whilst the splash screen is displayed
+            splash_screen = Splash()
+            splash_screen.name = 'splash'
+            splash_screen.hidden = True
+            self.tracker_screens.registerScreen(splash_screen)
+            self.tracker_screens.getScreen('splash').tick(time.time())
+            timeline.mark('request splash screen')
+
             data_bus = smbus.SMBus(1)
-            self.gps = TrackerGPS()
-            self.gps.loadlog() # Attempt to load previous day's log
+            self.gps = TrackerGPS() # Connects to gpsd when first started
+            self.gps.publisher = LivePublisher() # Live fixes for the web interface
+            self.status = StatusWriter() # State shared with other processes
+            self.gps.status = self.status
+            # Attempt to load previous day's log in the background
+            self.loader = Thread(target=self.loadlog)
+            self.loader.daemon = True
+            self.loader.start()
+            self.archiver.start() # Compress past days' logs in the background
+            timeline.mark('create GPS and start background tasks')
             
             activity_screen = SummaryScreen()
             activity_screen.name = 'Activity'
@@ -95,6 +158,7 @@ class trackerapp(object):
             diagnostics_screen = TrackerDiag()
             diagnostics_screen.name = 'Diagnostics'
             diagnostics_screen.bus = data_bus
+            diagnostics_screen.gps = self.gps
 
             sleep_screen = Lowpower()
             sleep_screen.name = "Sleep"
@@ -113,21 +177,35 @@ class trackerapp(object):
             self.tracker_screens.registerScreen(diagnostics_screen)
             self.tracker_screens.registerScreen(sleep_screen)
             self.tracker_screens.registerScreen(shutdown_screen)
+            timeline.mark('create screens')
 
             # Initiate first screen. 
             # This calls all the startup and ensures only the first
             # visible screen is shown
-            self.tracker_screens.nextScreen()
+            self.renderer.change(self.tracker_screens.nextScreen) # Splash may still be drawing
 
             self.runbtn.start()
             self.runbtn.indicator = False
         
             self.pwrbtn.start()
             self.pwrbtn.indicator = True
+            timeline.mark('start buttons')
+            first_frame = True
 
+            last_battery = 0
             while True:
                 t = time.time()
+                if t - last_battery > self.battery_period:
+                    last_battery = t
+                    self.publish_battery(data_bus)
                 self.tracker_screens.currentScreen().tick(t)
+                if first_frame:
+                    # First screen is drawn on the first tick
+                    if timeline.enabled:
+                        self.renderer.wait()
+                    timeline.mark('draw first screen')
+                    timeline.report()
+                    first_frame = False
                 self.pwrbtn.tick(t)
                 self.runbtn.tick(t)
 
@@ -138,22 +216,55 @@ class trackerapp(object):
                         
                 if self.pwrbtn.heldtime > 5:
                     self.pwr_held = True
-                    self.tracker_screens.getScreen('shutdown').tick(t)
+                    self.renderer.change(self.tracker_screens.getScreen, 'shutdown').tick(t)
+                    self.renderer.wait() # Power off screen must show before shutting down
                     self.shutdownpi()
                 
                 time.sleep(0.1)                                            
 
         except KeyboardInterrupt:
-            print ("Interrupt received, stopping tracker")
+            apptrace.info("Interrupt received, stopping tracker")
         except:
-            print ("Unhandled exception")
+            apptrace.error("Unhandled exception")
             raise
         #finally:
         self.pwrbtn.stop()
         self.runbtn.stop()
         self.gps.terminate()
+        self.archiver.terminate()
+        self.renderer.terminate()
         #exit()
             
+    def startgps(self):
+        self.gps.start()
+        self.gps.log_gps(True)
+
+    def stopgps(self):
+        self.gps.stop()
+        self.gps.log_gps(False)
+
+    def loadlog(self):
+        try:
+            entries = self.gps.loadlog()
+            timeline.mark('replay {0} log records (background)'.format(entries))
+        finally:
+            # Start the GPS if run was pressed whilst loading, even if the
+            # log couldn't be replayed
+            self.loaderlock.acquire()
+            try:
+                self.loaded = True
+                if self.start_when_loaded:
+                    self.start_when_loaded = False
+                    self.startgps()
+            finally:
+                self.loaderlock.release()
+
+    def publish_battery(self, bus):
+        try:
+            self.status.write(battery = bus.read_byte_data(appconfig['battsensor'],0x04))
+        except IOError:
+            self.status.write(battery = -1)
+
     def shutdownpi(self):
         for i in range(1,7):
             self.pwrbtn.indicator = not self.pwrbtn.indicator
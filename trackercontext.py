@@ -14,14 +14,17 @@
 
 from trackerdisplay import *
 from trackergps import TrackerGPS
+from trackersysinfo import SystemInfo
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 import smbus
 import time
-import subprocess
 from datetime import datetime
 from config import appconfig
+from trackertrace import trace
+
+sensortrace = trace.category('sensors') # Battery and temperature readings
 
 class GPS1SubScreen(BasicScreen):
       def __init__(self):
@@ -30,89 +33,88 @@ class GPS1SubScreen(BasicScreen):
             self.fontsize = 20
             self.indent = 10
 
-      def draw(self):
+      def drawbackground(self):
             line = 0
-            self.clearScreen(1)
+            for (label, field) in [('Time: ', 'time'), ('Lon: ', 'lon'), ('Lat: ', 'lat'), ('East: ', 'east'), ('North: ', 'north')]:
+                  self.writeLabel(label, self.indent, line, self.fontsize, field)
+                  line += self.fontsize
+
+      def draw(self):
+            self.layout()
             if self.gps is None:
                   raise DisplayError("No GPS object configured")
 
             if self.gps.isrunning:
                   gpsinfo = self.gps.data.info
-                  self.writeText(u'Time: {0:02d}:{1:02d}:{2:02d} \N{PLUS-MINUS SIGN} {3:.1f}sec'.format(self.gps.time.hour, self.gps.time.minute, self.gps.time.second, self.gps.error_time),self.indent, line, self.fontsize)
-                  line += self.fontsize
+                  self.setField('time', u'{0:02d}:{1:02d}:{2:02d} \N{PLUS-MINUS SIGN} {3:.1f}sec'.format(self.gps.time.hour, self.gps.time.minute, self.gps.time.second, self.gps.error_time))
 
                   if self.gps.mode >= 2:
-                        (east, north) = self.gps.WGS84toOSGB36(gpsinfo['latitude'], gpsinfo['longitude'])
-                        self.writeText(u'Lon: {0:.6f} \N{PLUS-MINUS SIGN} {1:.2f}'.format(gpsinfo['longitude'], gpsinfo['error_longitude']),self.indent,line,self.fontsize)
-                        line += self.fontsize
-                        self.writeText(u'Lat: {0:.6f} \N{PLUS-MINUS SIGN} {1:.2f}'.format(gpsinfo['latitude'], gpsinfo['error_latitude']),self.indent,line,self.fontsize)
-                        line += self.fontsize
-                        self.writeText('East: {0:.2f}'.format(east),self.indent,line,self.fontsize)
-                        line += self.fontsize
-                        self.writeText('North: {0:.2f}'.format(north),self.indent,line,self.fontsize)
+                        (east, north) = self.gps.WGS84toOSGB36(gpsinfo.latitude, gpsinfo.longitude)
+                        self.setField('lon', u'{0:.6f} \N{PLUS-MINUS SIGN} {1:.2f}'.format(gpsinfo.longitude, gpsinfo.error_longitude))
+                        self.setField('lat', u'{0:.6f} \N{PLUS-MINUS SIGN} {1:.2f}'.format(gpsinfo.latitude, gpsinfo.error_latitude))
+                        self.setField('east', '{0:.2f}'.format(east))
+                        self.setField('north', '{0:.2f}'.format(north))
+                  else:
+                        for field in ['lon', 'lat', 'east', 'north']:
+                              self.setField(field, '')
 
             else:
-                  self.writeText('Time: --:--:--',self.indent, line, self.fontsize)
-                  line += self.fontsize
-                  self.writeText('Lon: --',self.indent, line, self.fontsize)
-                  line += self.fontsize
-                  self.writeText('Lat: --',self.indent, line, self.fontsize)
-                  line += self.fontsize
-                  self.writeText('East: --',self.indent, line, self.fontsize)
-                  line += self.fontsize
-                  self.writeText('North: --',self.indent, line, self.fontsize)
+                  self.setField('time', '--:--:--')
+                  for field in ['lon', 'lat', 'east', 'north']:
+                        self.setField(field, '--')
 
 class GPS2SubScreen(GPS1SubScreen):
-      def draw(self):
+      def drawbackground(self):
             line = 0
-            self.clearScreen(1)
+            for (label, field) in [('Speed: ', 'speed'), ('Alt: ', 'alt'), ('Climb: ', 'climb')]:
+                  self.writeLabel(label, self.indent, line, self.fontsize, field)
+                  line += self.fontsize
+
+      def draw(self):
+            self.layout()
             if self.gps is None:
                   raise DisplayError("No GPS object configured")
             if self.gps.isrunning and self.gps.mode >= 2:
                   gpsinfo = self.gps.data.info
-                  self.writeText(u'Speed: {0} \N{PLUS-MINUS SIGN} {1:.2f}m/s'.format(gpsinfo['speed'], gpsinfo['error_speed']),self.indent,line,self.fontsize)
-                  line += self.fontsize
-                  self.writeText(u'Alt: {0} \N{PLUS-MINUS SIGN} {1:.2f}m'.format(gpsinfo['altitude'], gpsinfo['error_altitude']),self.indent,line,self.fontsize)
-                  line += self.fontsize
-                  self.writeText(u'Climb: {0} \N{PLUS-MINUS SIGN} {1:.2f}m'.format(gpsinfo['climb'], gpsinfo['error_climb']),self.indent,line,self.fontsize)
+                  self.setField('speed', u'{0} \N{PLUS-MINUS SIGN} {1:.2f}m/s'.format(gpsinfo.speed, gpsinfo.error_speed))
+                  self.setField('alt', u'{0} \N{PLUS-MINUS SIGN} {1:.2f}m'.format(gpsinfo.altitude, gpsinfo.error_altitude))
+                  self.setField('climb', u'{0} \N{PLUS-MINUS SIGN} {1:.2f}m'.format(gpsinfo.climb, gpsinfo.error_climb))
             else:
-                  self.writeText('Speed: --',self.indent, line, self.fontsize)
-                  line += self.fontsize
-                  self.writeText('Alt: --',self.indent, line, self.fontsize)
-                  line += self.fontsize
-                  self.writeText('Climb: --',self.indent, line, self.fontsize)
+                  for field in ['speed', 'alt', 'climb']:
+                        self.setField(field, '--')
 
 class GPS3SubScreen(GPS1SubScreen):
+      def drawbackground(self):
+            self.writeLabel('Satellites: ', self.indent, 0, self.fontsize, 'satellites')
+            self.writeLabel('Satellites in use: ', self.indent, self.fontsize, self.fontsize, 'used')
+
       def draw(self):
-            line = 0
-            self.clearScreen(1)
+            self.layout()
             if self.gps is None:
                   raise DisplayError("No GPS object configured")
             if self.gps.isrunning:
-                  self.writeText('Satellites: {0}'.format(self.gps.satellites),self.indent,line,self.fontsize)
-                  line += self.fontsize
-                  self.writeText('Satellites in use: {0}'.format(self.gps.satellites_used),self.indent,line,self.fontsize)
+                  self.setField('satellites', '{0}'.format(self.gps.satellites))
+                  self.setField('used', '{0}'.format(self.gps.satellites_used))
             else:
-                  self.writeText('Satellites: --',self.indent, line, self.fontsize)
-                  line += self.fontsize
-                  self.writeText('Satellites in use: --',self.indent, line, self.fontsize)
+                  self.setField('satellites', '--')
+                  self.setField('used', '--')
 
             
 class StatusContainer(ScreenDisplay):
       def loadresources(self):
-            self.battlow = Image.open(appconfig['images'] + 'battlow.png').convert(mode='1')
-            self.batt100 = Image.open(appconfig['images'] + 'batt100.png').convert(mode='1')
-            self.batt75 = Image.open(appconfig['images'] + 'batt75.png').convert(mode='1')
-            self.batt50 = Image.open(appconfig['images'] + 'batt50.png').convert(mode='1')
-            self.batt25 = Image.open(appconfig['images'] + 'batt25.png').convert(mode='1')
-            self.gpsimg = Image.open(appconfig['images'] + 'satellite.png').convert(mode='1')
-            self.trackingimg = Image.open(appconfig['images'] + 'gpstracking.png').convert(mode='1')
+            self.battlow = loadimage('battlow.png')
+            self.batt100 = loadimage('batt100.png')
+            self.batt75 = loadimage('batt75.png')
+            self.batt50 = loadimage('batt50.png')
+            self.batt25 = loadimage('batt25.png')
+            self.gpsimg = loadimage('satellite.png')
+            self.trackingimg = loadimage('gpstracking.png')
 
       def __init__(self):
             ScreenDisplay.__init__(self)
 
             self.partial_refresh_time = 5
-            self.full_refresh_time = 120
+            self.partial_budget = 24
             self.border = 5
             self.header = 20
             self.bus = None
@@ -128,16 +130,47 @@ class StatusContainer(ScreenDisplay):
             self.sub_size = (width, height)
             self.subscreens.image = Image.new('1', self.sub_size, 1)
 
+      def drawbackground(self):
+            # Status bar is split into the GPS status and battery fields.
+            # All battery images are the same size
+            x = self.image.size[0] - self.batt100.size[0] - self.border
+            self.addField('battery', x, self.border, 0, self.batt100.size[0], self.batt100.size[1])
+            self.addField('gps', 0, 0, 0, x, self.sub_offset['top'])
+
+      def layout(self):
+            if not self.layered:
+                  # The background is pasted over the sub screen too so
+                  # it must be drawn again in full rather than only its changes
+                  try:
+                        self.subscreens.currentScreen().layered = False
+                  except DisplayError:
+                        pass
+            ScreenDisplay.layout(self)
+
       def draw(self):
-            self.clearScreen(1)
+            self.layout()
             battimg = self.getBattImage(self.percent)
-            x = self.image.size[0] - battimg.size[0] - self.border
-            self.image.paste(battimg, box=(x,self.border))
+            if self.changed('battery', battimg):
+                  self.image.paste(battimg, box=self.fields['battery'][0][:2])
             if self.gps is None:
                   raise DisplayException("No GPS object configured")
+            if self.changed('gps', (self.gps.isrunning, self.gps.mode, self.gps.islogging, self.gps.resting)):
+                  self.drawgps()
+
+            try:
+                  subscreen = self.subscreens.currentScreen()
+                  subscreen.draw()
+                  self.pastedamage(subscreen, (self.sub_offset['left'], self.sub_offset['top']))
+            except DisplayError:
+                  # Fails if no screens registered
+                  pass
+
+      def drawgps(self):
             if self.gps.isrunning:
                   self.image.paste(self.gpsimg, box=(self.border, self.border))
-                  if self.gps.mode >= 2:
+                  if self.gps.resting:
+                        self.writeText('Resting', self.border+self.gpsimg.size[0],self.border,15)
+                  elif self.gps.mode >= 2:
                         if self.gps.islogging:
                               self.image.paste(self.trackingimg, box=(self.border+self.gpsimg.size[0], self.border))
                         if self.gps.mode >=3:
@@ -149,13 +182,6 @@ class StatusContainer(ScreenDisplay):
             else:
                   self.writeText('GPS Disabled',0,5,15)
 
-            try:
-                  self.subscreens.currentScreen().draw()
-                  self.image.paste(self.subscreens.currentScreen().image, box=(self.sub_offset['left'], self.sub_offset['top']))
-            except DisplayError:
-                  # Fails if no screens registered
-                  pass
-
       def getBattImage(self, percent):
             if percent > 75:
                   return self.batt100
@@ -175,7 +201,7 @@ class StatusContainer(ScreenDisplay):
             try:
                   raw_val = self.bus.read_byte_data(appconfig['battsensor'],0x04)
             except IOError:
-                  print "IO Error received reading battery"
+                  sensortrace.warning("IO Error received reading battery")
                   return 0
             
             return raw_val
@@ -205,7 +231,7 @@ class TrackerMain(StatusContainer):
             self.subgps3.gps = obj
 
       def enter(self):
-            BasicScreen.enter(self)
+            StatusContainer.enter(self)
             if self.gps is not None:
                   self.gps.start()
 
@@ -219,15 +245,17 @@ class Lowpowersub(BasicScreen):
             BasicScreen.__init__(self)
             self.fontsize = 20
             self.indent = 10
-            self.pwrimg = Image.open(appconfig['images'] + 'pwrsave.png').convert(mode='1')
+            self.pwrimg = loadimage('pwrsave.png')
 
-      def draw(self):
+      def drawbackground(self):
             line = 0
-            self.clearScreen(1)
             self.image.paste(self.pwrimg, box=(0, 0))
             self.writeText("Low Power Screen", self.indent, line, self.fontsize)
             line += self.fontsize
             self.writeText("Press power button briefly to exit", self.indent, line, 16)
+
+      def draw(self):
+            self.layout() # Nothing changes
             
 class Lowpower(StatusContainer):
       'Low refresh screen'
@@ -235,13 +263,13 @@ class Lowpower(StatusContainer):
       def __init__(self):
             StatusContainer.__init__(self)
             self.partial_refresh_time = 1800
-            self.full_refresh_time = 7200
+            self.partial_budget = 4
             self.pwrbtn = None
             self.runbtn = None
             self.bus = None
             self.prev_pwrbtn = True
             self.prev_runbtn = False
-            self.pwrimg = Image.open(appconfig['images'] + 'pwrsave.png').convert(mode='1')
+            self.pwrimg = loadimage('pwrsave.png')
             self.sub1 = Lowpowersub()
             self.subscreens.registerScreen(self.sub1)
 
@@ -252,6 +280,8 @@ class Lowpower(StatusContainer):
             
       def enter(self):
             StatusContainer.enter(self)
+            if self.gps is not None:
+                  self.gps.setlowpower(True)
             if self.pwrbtn is not None:
                   self.prev_pwrbtn = self.pwrbtn.indicator
                   self.pwrbtn.indicator = False
@@ -260,6 +290,8 @@ class Lowpower(StatusContainer):
                   self.runbtn.indicator = False
 
       def finish(self):
+            if self.gps is not None:
+                  self.gps.setlowpower(False)
             if self.pwrbtn is not None:
                   self.pwrbtn.indicator = self.prev_pwrbtn
             if self.runbtn is not None:
@@ -281,6 +313,14 @@ class Shutdown(ScreenDisplay):
             if self.gps is not None:
                   self.writeText('Sessions: {0}'.format(self.gps.data.sessions_recorded),0,75,25)
             
+class Splash(ScreenDisplay):
+      'Shown whilst the tracker starts'
+
+      def draw(self):
+            self.clearScreen(1)
+            self.writeText('GPS Tracker', 10, 50, 40)
+            self.writeText('Starting...', 10, 100, 20)
+
 class TrackerDiag(ScreenDisplay):
       'Display system diagnostics'
 
@@ -289,58 +329,72 @@ class TrackerDiag(ScreenDisplay):
 
             # Initialise any context variables used
             self.partial_refresh_time = 5
-            self.full_refresh_time = 300
-            self.net_refresh = 60
+            self.partial_budget = 60
             self.bus = None
-            self.ip = 'No Network'
-            self.fontsize = 18
+            self.gps = None
+            self.fontsize = 15
             self.tabstop = 120
+            # System information is collected in the background so
+            # the screen only waits on the file system for the first
+            # snapshot, taken when the screen is first entered
+            self.sysinfo = SystemInfo()
 
       def enter(self):
             ScreenDisplay.enter(self)
-            self.update_network_info()
-            
-      def update_network_info(self):
-            exe = subprocess.Popen(["hostname", "-I"], stdout=subprocess.PIPE)
-            self.ip = exe.communicate()[0].rstrip()
-            if len(self.ip) == 0:
-                  self.ip = 'No Network'
-            
-      def tick(self,t):
-            ScreenDisplay.tick(self,t)
-            if t - self.last_tick > self.net_refresh:
-                  self.update_network_info()
-                  
-      def draw(self):
-            startline = 30
-            self.clearScreen(1)
-            self.writeText('System',0,5,20)
-            self.writeText('Network:',0,startline,self.fontsize)
-            self.writeText(self.ip, self.tabstop, startline, self.fontsize)
+            self.sysinfo.start()
 
-            startline += self.fontsize
-            self.writeText('Internal Temp:',0,startline,self.fontsize)
-            self.writeText(u'{0:.1f}\N{DEGREE SIGN}C'.format(self.temperature), self.tabstop, startline, self.fontsize)
+      def finish(self):
+            self.sysinfo.stop()
 
-            startline += self.fontsize
-            self.writeText('Battery %:',0,startline,self.fontsize)
-            self.writeText('{0}%'.format(self.battpercent), self.tabstop, startline, self.fontsize)
+      @property
+      def ip(self):
+            addresses = self.sysinfo.snapshot['ip']
+            if len(addresses) == 0:
+                  return 'No Network'
+            return ' '.join(addresses)
+
+      def drawbackground(self):
+            startline = 30
+            self.writeText('System',0,5,20)
+            self.addField('uptime', self.tabstop, 5, self.fontsize)
+            for (label, field) in [('Network:', 'ip'), ('Internal Temp:', 'temp'), ('CPU:', 'cpu'),
+                                   ('Memory free:', 'memory'), ('SD free:', 'disk'), ('Battery %:', 'battpercent'),
+                                   ('Battery V:', 'battvoltage'), ('Internal Time:', 'time'), ('gpsd:', 'gpsd')]:
+                  self.writeText(label,0,startline,self.fontsize)
+                  self.addField(field, self.tabstop, startline, self.fontsize)
+                  startline += self.fontsize
 
-            startline += self.fontsize
-            self.writeText('Battery V:',0,startline,self.fontsize)
-            self.writeText('{0:.1f}mV'.format(self.battvoltage), self.tabstop, startline, self.fontsize)
+      def draw(self):
+            info = self.sysinfo.snapshot
+            self.layout()
+            uptime = int(info['uptime'])
+            self.setField('uptime', 'Up {0}h {1:02d}m'.format(uptime // 3600, (uptime % 3600) // 60))
+            self.setField('ip', self.ip)
+            self.setField('temp', u'{0:.1f}\N{DEGREE SIGN}C'.format(self.temperature))
+
+            if info['cpu_temp'] is None:
+                  self.setField('cpu', 'Load {0:.2f}'.format(info['load'][0]))
+            else:
+                  self.setField('cpu', u'{0:.1f}\N{DEGREE SIGN}C Load {1:.2f}'.format(info['cpu_temp'], info['load'][0]))
 
-            startline += self.fontsize
-            self.writeText('Internal Time:',0,startline,self.fontsize)
+            self.setField('memory', '{0}/{1}MB'.format(info['mem_free_kb'] // 1024, info['mem_total_kb'] // 1024))
+            self.setField('disk', '{0}/{1}MB'.format(info['disk_free_kb'] // 1024, info['disk_total_kb'] // 1024))
+            self.setField('battpercent', '{0}%'.format(self.battpercent))
+            self.setField('battvoltage', '{0:.1f}mV'.format(self.battvoltage))
             t = datetime.now()
-            self.writeText('{0:02d}:{1:02d}:{2:02d}'.format(t.hour, t.minute, t.second),self.tabstop, startline, self.fontsize)
+            self.setField('time', '{0:02d}:{1:02d}:{2:02d}'.format(t.hour, t.minute, t.second))
+            if self.gps is not None:
+                  if self.gps.disconnected is not None:
+                        self.setField('gpsd', 'Down {0}s'.format(int(time.time() - self.gps.disconnected)))
+                  else:
+                        self.setField('gpsd', 'Reconn {0} Stall {1}'.format(self.gps.reconnects, self.gps.stalls))
 
       @property
       def battpercent(self):
             try:
                   raw_val = self.bus.read_byte_data(appconfig['battsensor'],0x04)
             except IOError:
-                  print "IO Error received reading battery"
+                  sensortrace.warning("IO Error received reading battery")
                   return 0
 		
             return raw_val
@@ -353,7 +407,7 @@ class TrackerDiag(ScreenDisplay):
                   high_val = self.bus.read_byte_data(appconfig['battsensor'],0x02)
                   low_val = self.bus.read_byte_data(appconfig['battsensor'],0x03)
             except IOError:
-                  print ("IO Error received reading battery")
+                  sensortrace.warning("IO Error received reading battery")
                   return 0
 		
             raw_val = ((low_val | (high_val << 8)) >> 4)
@@ -365,7 +419,7 @@ class TrackerDiag(ScreenDisplay):
             try:
                   raw_temp = self.bus.read_word_data(appconfig['tempsensor'],0x00)
             except IOError:
-                  print ("IO Error received reading temperature")
+                  sensortrace.warning("IO Error received reading temperature")
                   return 0
 
             return self.reverse_word_bytes(raw_temp) * 0.125
@@ -13,11 +13,45 @@
 # limitations under the License.
 
 from papirus import Papirus
+import time
+from threading import Thread, Condition, RLock
+from math import ceil
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
 from config import appconfig
 
+# One Papirus object and one copy of each image and font are shared by all screens
+shared_papirus = None
+images = {}
+fonts = {}
+
+def papirus():
+    global shared_papirus
+    if shared_papirus is None:
+        shared_papirus = Papirus()
+    return shared_papirus
+
+def loadimage(name):
+    # Load a 1 bit image from the resources directory
+    if name not in images:
+        images[name] = Image.open(appconfig['images'] + name).convert(mode='1')
+    return images[name]
+
+def loadfont(size):
+    # Load the configured font at a point size
+    if size not in fonts:
+        fonts[size] = ImageFont.truetype(appconfig['font'], size)
+    return fonts[size]
+
+def textwidth(t, size):
+    # Width of t in the configured font. getsize was removed in Pillow 10
+    # and getlength only arrived in Pillow 8
+    font = loadfont(size)
+    if hasattr(font, 'getlength'):
+        return int(ceil(font.getlength(t)))
+    return font.getsize(t)[0]
+
 class DisplayError(Exception):
     'Standard error class for PaPiRus display'
     
@@ -37,6 +71,14 @@ class BasicScreen(object):
         self.drawobj = None
         # Set hidden to True to prevent appearing in prev and next calls
         self.hidden = False
+
+        # Screens can draw everything which doesn't change once in
+        # drawbackground. The background is cached and draw then only
+        # redraws fields whose values have changed
+        self.background = None
+        self.layered = False # True when the background is on the image
+        self.fields = {} # Field name to [box, font size, value shown]
+        self.damage = [] # Regions changed since the image was last displayed
         
     @property
     def name(self):
@@ -53,6 +95,8 @@ class BasicScreen(object):
         # doing their own processing
         if self.drawobj is None:
             self.drawobj = ImageDraw.Draw(self.image)
+        # Another screen may have drawn on the shared image
+        self.layered = False
 
     def finish(self):
         # Do any required clean up
@@ -67,15 +111,83 @@ class BasicScreen(object):
             raise DisplayError("No draw object")
 
         self.drawobj.rectangle([(0,0),self.image.size], fill = colour)
+        self.damage.append((0, 0) + self.image.size)
 
     # Helper function to create simple text on PaPirus screen
     def writeText(self, t, x, y, size):
         if self.drawobj is None:
             raise DisplayError("No draw object")
 
-        #fnt = ImageFont.truetype('/usr/share/fonts/truetype/freefont/FreeMono.ttf', size)
-        fnt = ImageFont.truetype(appconfig['font'], size)
-        self.drawobj.text((x,y), t, font=fnt, fill=0)
+        self.drawobj.text((x,y), t, font=loadfont(size), fill=0)
+
+    def drawbackground(self):
+        # Draw the parts of the screen which never change, such as
+        # labels and icons. Override this and add a field for each value
+        # shown. The values are drawn in draw with setField
+        pass
+
+    def discardbackground(self):
+        # Call if the background needs drawing again, e.g. units changed
+        self.background = None
+
+    def layout(self):
+        # Put the background on the image, drawing it on first use.
+        # Call this at the start of draw for screens using fields
+        if self.background is None:
+            self.fields = {}
+            self.clearScreen(1)
+            self.drawbackground()
+            self.background = self.image.copy()
+        elif not self.layered:
+            self.image.paste(self.background, box=(0,0))
+            self.damage.append((0, 0) + self.image.size)
+            for field in self.fields.values():
+                field[2] = None # Nothing is shown in the field
+        self.layered = True
+
+    def addField(self, name, x, y, size, width = None, height = None):
+        # Fixed region of the screen for a value. Text is clipped to the
+        # region. Width defaults to the rest of the line and height to the font
+        if width is None:
+            width = self.image.size[0] - x
+        if height is None:
+            (ascent, descent) = loadfont(size).getmetrics()
+            height = ascent + descent
+        self.fields[name] = [(x, y, x + width, y + height), size, None]
+
+    def writeLabel(self, t, x, y, size, field = None):
+        # Write background text, optionally adding a field straight after it
+        self.writeText(t, x, y, size)
+        if field is not None:
+            self.addField(field, x + textwidth(t, size), y, size)
+
+    def changed(self, name, value):
+        # True if the field isn't showing value. The field is cleared
+        # back to the background ready to draw the new value
+        field = self.fields[name]
+        if field[2] == value:
+            return False
+        box = field[0]
+        self.image.paste(self.background.crop(box), box=box[:2])
+        self.damage.append(box)
+        field[2] = value
+        return True
+
+    def setField(self, name, t):
+        # Show text in a field if it has changed
+        if self.changed(name, t):
+            (box, size, value) = self.fields[name]
+            tile = self.background.crop(box)
+            ImageDraw.Draw(tile).text((0,0), t, font=loadfont(size), fill=0)
+            self.image.paste(tile, box=box[:2])
+
+    def pastedamage(self, screen, offset):
+        # Copy the regions changed on another screen's image to this one
+        for box in screen.damage:
+            (x, y) = (box[0] + offset[0], box[1] + offset[1])
+            self.image.paste(screen.image.crop(box), box=(x, y))
+            self.damage.append((x, y, x + box[2] - box[0], y + box[3] - box[1]))
+        screen.damage = []
         
     @staticmethod
     def reverse_word_bytes(w):
@@ -84,6 +196,51 @@ class BasicScreen(object):
             bitval -=2048
         return bitval
 
+class RefreshScheduler(object):
+    'Coalesces screen invalidations and counts partial updates against a ghosting budget'
+
+    def __init__(self):
+        # Invalidations are held until none have arrived for window seconds
+        # but never for longer than maxdelay seconds
+        self.window = 0.3
+        self.maxdelay = 1.0
+        self.first_invalidate = None
+        self.last_invalidate = None
+        self.partials = 0 # Partial updates since the last full update
+        self.coalesced = 0 # Invalidations merged into another refresh
+
+    def invalidate(self, t):
+        if self.first_invalidate is None:
+            self.first_invalidate = t
+        else:
+            self.coalesced += 1
+        self.last_invalidate = t
+
+    @property
+    def invalidated(self):
+        return self.first_invalidate is not None
+
+    def due(self, t):
+        # True once an invalidation has waited long enough for any others to arrive
+        if self.first_invalidate is None:
+            return False
+        return t - self.last_invalidate >= self.window or t - self.first_invalidate >= self.maxdelay
+
+    def usefull(self, budget):
+        # Ghosting builds up with each partial update. budget of -1 allows unlimited partials
+        return budget >= 0 and self.partials >= budget
+
+    def displayed(self, full):
+        if full:
+            self.partials = 0
+        else:
+            self.partials += 1
+
+    def reset(self):
+        # Forget any waiting invalidation
+        self.first_invalidate = None
+        self.last_invalidate = None
+
 # NOTE: Be really, really careful renaming this class. There are instance checks in the Screen
 # class which assume this class name
 class ScreenDisplay(BasicScreen):
@@ -92,25 +249,25 @@ class ScreenDisplay(BasicScreen):
     def __init__(self):
         BasicScreen.__init__(self)
         self.last_tick = 0
-        self.last_full_refresh = 0
         self.pap = None
+        self.renderer = None # RenderThread to draw with, otherwise draw on tick
+        self.scheduler = RefreshScheduler()
         self.do_full_refresh = True # Flag to force full screen update
 
         # Refresh times can be disabled with -1
-        # Refreshes are actually driven by the partial times
-        # so at least partial times need setting to enable
-        # any refreshes. Make these times match if just full refreshes
-        # are wanted.
-        # Full refreshes happen on the next partial refresh interval
+        # Refreshes are driven by the partial time and invalidate calls.
+        # A full refresh replaces a partial one when the screen is entered
+        # or once partial_budget partial refreshes have been made since the
+        # last full refresh. Ghosting builds up on e-ink with each partial
+        # refresh. -1 allows any number of partial refreshes.
         self.partial_refresh_time = -1 # disable
-        self.full_refresh_time = -1 # disable
+        self.partial_budget = -1
 
     def invalidate(self):
-        # Full updates can be driven by self.do_full_refresh attribute
-        # This call resets last_tick so either a partial or full is
-        # conducted on next tick. This is useful for smaller screen
-        # events
-        self.last_tick = 0
+        # Request a refresh soon. Invalidations close together are
+        # merged into a single refresh. This is useful for smaller
+        # screen events such as button presses
+        self.scheduler.invalidate(time.time())
         
     def tick(self, t):
         # Use this to capture time passed and
@@ -119,20 +276,41 @@ class ScreenDisplay(BasicScreen):
         # it spends processing. Recommendation is quick processing per tick.
         # Longer jobs/processing should be started in a new thread.
 
-        if self.full_refresh_time > 0:
-            # Set full refresh flag for next draw call 
-            if t - self.last_full_refresh > self.full_refresh_time:
-                self.do_full_refresh = True
-
-        if self.partial_refresh_time > 0 or self.do_full_refresh:
+        if self.do_full_refresh:
+            # Just entered, so show the screen straight away. Splash and
+            # shutdown screens are only ticked once
+            self.last_tick = t
+            self.refresh()
+        elif self.scheduler.invalidated:
+            # Wait for any more invalidations before refreshing
+            if self.scheduler.due(t):
+                self.last_tick = t
+                self.refresh()
+        elif self.partial_refresh_time > 0:
             # Work out if a screen refresh is due 
             if t - self.last_tick > self.partial_refresh_time:
                 self.last_tick = t
-                self.draw() # execute a screen redraw
-                self.display() # finally update the display
+                self.refresh()
+
+    def refresh(self):
+        # Redraw and update the display. With a render thread this
+        # only requests the frame and returns straight away
+        full = self.do_full_refresh or self.scheduler.usefull(self.partial_budget)
+        self.scheduler.reset()
+        if full:
+            self.do_full_refresh = False
+        if self.renderer is None:
+            self.render(full)
+        else:
+            self.renderer.request(self, full)
+
+    def render(self, full):
+        self.draw() # execute a screen redraw
+        self.display(full) # finally update the display
             
     def enter(self):
         BasicScreen.enter(self)
+        self.scheduler.reset() # Drop invalidations from the last time on screen
         self.do_full_refresh = True
 
     def draw(self):
@@ -148,18 +326,115 @@ class ScreenDisplay(BasicScreen):
         self.clearScreen(1)
         self.writeText("Tracker", 10, 50, 40)
         
-    def display(self):
+    def display(self, full = None):
         # write changes to the screen
         # Called from tick events but will need special calling
         # if refresh is required for other reasons
+        if full is None:
+            full = self.do_full_refresh
+            if full:
+                self.do_full_refresh = False
+
+        if not full and len(self.damage) == 0:
+            return # Nothing changed so leave the e-ink alone
+        self.damage = []
+
         self.pap.display(self.image)
         
-        if self.do_full_refresh:
-            self.last_full_refresh = self.last_tick
+        if full:
             self.pap.update()
-            self.do_full_refresh = False
         else:
             self.pap.partial_update()
+        self.scheduler.displayed(full)
+
+class RenderThread(Thread):
+    'Draws and updates the display so the main loop is never blocked by the e-ink refresh'
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.cond = Condition()
+        self.pending = None # Newest (screen, full) frame waiting to render
+        self.busy = False
+        self.requested = 0
+        self.rendered = 0
+        self.skipped = 0 # Frames replaced by a newer request before rendering
+        self.drawing = RLock() # Held whilst a frame is drawn and whilst screens change
+        self.__quit = False
+
+    def request(self, screen, full):
+        # Replace any waiting frame with this one. A full refresh which
+        # hasn't happened yet is kept for the same screen
+        self.cond.acquire()
+        if self.pending is not None:
+            self.skipped += 1
+            if self.pending[0] is screen:
+                full = full or self.pending[1]
+        self.pending = (screen, full)
+        self.requested += 1
+        self.cond.notify_all()
+        self.cond.release()
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            while self.pending is None and not self.__quit:
+                self.cond.wait()
+            if self.__quit:
+                self.cond.release()
+                break
+            (screen, full) = self.pending
+            self.pending = None
+            self.busy = True
+            self.cond.release()
+
+            self.drawing.acquire()
+            try:
+                screen.render(full)
+            except Exception as e:
+                print ("Error drawing screen {0}: {1}".format(screen.name, e))
+            finally:
+                self.drawing.release()
+
+            self.cond.acquire()
+            self.busy = False
+            self.rendered += 1
+            self.cond.notify_all() # Wake anything waiting for completion
+            self.cond.release()
+
+    def change(self, fn, *args):
+        # Call fn, which changes screens, between frames. Entering or
+        # leaving a screen resets what it draws so must not happen whilst
+        # the screen is being drawn. Blocks until any frame being drawn is done
+        self.drawing.acquire()
+        try:
+            return fn(*args)
+        finally:
+            self.drawing.release()
+
+    def wait(self, timeout = None):
+        # Block until every requested frame has been displayed
+        self.cond.acquire()
+        while (self.pending is not None or self.busy) and self.is_alive():
+            self.cond.wait(timeout)
+            if timeout is not None:
+                break
+        self.cond.release()
+
+    @property
+    def idle(self):
+        self.cond.acquire()
+        idle = self.pending is None and not self.busy
+        self.cond.release()
+        return idle
+
+    def terminate(self):
+        self.cond.acquire()
+        self.__quit = True
+        self.cond.notify_all()
+        self.cond.release()
+        if self.is_alive():
+            self.join()
 
 
 class Screens(object):
@@ -168,8 +443,9 @@ class Screens(object):
     def __init__(self):
         self.screen_list = []
         self.current_screen = -1
-        self.pap = Papirus()
+        self.pap = papirus()
         self.image = Image.new('1', self.pap.size, 1)
+        self.renderer = None # Set a RenderThread before registering screens to use it
             
     def registerScreen(self, screen):
         if not isinstance(screen, BasicScreen):
@@ -177,6 +453,7 @@ class Screens(object):
         screen.image = self.image # copy image to screen
         if isinstance(screen, ScreenDisplay):
             screen.pap = self.pap # reference the Papirus object
+            screen.renderer = self.renderer
         self.screen_list.append(screen)
 
     def count(self):
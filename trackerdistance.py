@@ -0,0 +1,214 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Distance engines used by GPSSummary to measure each step between fixes.
+# The engine is chosen by distance in config.py:
+#   haversine - great circle on a sphere of the mean earth radius
+#   fast      - flat earth for small steps using the WGS84 radii of curvature
+#               at the current latitude, which are cached. Falls back to
+#               haversine for large steps
+#   vincenty  - Vincenty's inverse formula on the WGS84 ellipsoid, accurate to
+#               well under a millimetre but the slowest
+# Every engine takes degrees and returns km.
+# Running this file times each engine on logs and reports their differences.
+
+import sys
+import json
+import time
+import argparse
+from math import sqrt, pi, sin, cos, tan, atan, atan2, radians, asin
+from trackerlog import openlog
+from config import appconfig
+
+mean_radius = 6371.0 # km
+
+# WGS84 ellipsoid in km
+wgs84_a = 6378.137
+wgs84_f = 1 / 298.257223563
+wgs84_b = wgs84_a * (1 - wgs84_f)
+wgs84_e2 = wgs84_f * (2 - wgs84_f)
+
+def haversine(lon1, lat1, lon2, lat2):
+    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    c = 2 * asin(sqrt(a))
+    return mean_radius * c
+
+class Haversine(object):
+    'Great circle distance on a sphere of the mean earth radius'
+
+    def distance(self, lon1, lat1, lon2, lat2):
+        return haversine(lon1, lat1, lon2, lat2)
+
+class Equirectangular(object):
+    'Flat earth distance for small steps using cached radii of the WGS84 ellipsoid'
+
+    def __init__(self, limit = 0.05, refresh = 0.005):
+        # Steps over limit degrees are measured by the fallback. The radii
+        # are worked out again when the latitude moves refresh degrees
+        self.limit = limit
+        self.refresh = refresh
+        self.fallback = haversine
+        self.latitude = 1000.0 # Not a latitude so the first call sets the radii
+        self.kmperlat = 0.0
+        self.kmperlon = 0.0
+
+    def setlatitude(self, latitude):
+        # km per degree along the meridian and the parallel at latitude
+        phi = radians(latitude)
+        w = 1 - wgs84_e2 * sin(phi)**2
+        meridional = wgs84_a * (1 - wgs84_e2) / (w * sqrt(w))
+        normal = wgs84_a / sqrt(w)
+        self.latitude = latitude
+        self.kmperlat = meridional * pi / 180
+        self.kmperlon = normal * cos(phi) * pi / 180
+
+    def distance(self, lon1, lat1, lon2, lat2):
+        dlat = lat2 - lat1
+        dlon = lon2 - lon1
+        if dlat > self.limit or dlat < -self.limit or dlon > self.limit or dlon < -self.limit:
+            return self.fallback(lon1, lat1, lon2, lat2)
+        mid = lat1 + dlat / 2
+        if mid - self.latitude > self.refresh or self.latitude - mid > self.refresh:
+            self.setlatitude(mid)
+        x = dlon * self.kmperlon
+        y = dlat * self.kmperlat
+        return sqrt(x*x + y*y)
+
+class Vincenty(object):
+    'Distance on the WGS84 ellipsoid by Vincenty\'s inverse formula'
+
+    def __init__(self, iterations = 200):
+        self.iterations = iterations
+        self.fallback = haversine # Nearly antipodal points don't converge
+
+    def distance(self, lon1, lat1, lon2, lat2):
+        if lon1 == lon2 and lat1 == lat2:
+            return 0.0
+        L = radians(lon2 - lon1)
+        U1 = atan((1 - wgs84_f) * tan(radians(lat1)))
+        U2 = atan((1 - wgs84_f) * tan(radians(lat2)))
+        sinU1 = sin(U1)
+        cosU1 = cos(U1)
+        sinU2 = sin(U2)
+        cosU2 = cos(U2)
+        lam = L
+        for i in range(self.iterations):
+            sinlam = sin(lam)
+            coslam = cos(lam)
+            sinsigma = sqrt((cosU2 * sinlam)**2 + (cosU1 * sinU2 - sinU1 * cosU2 * coslam)**2)
+            if sinsigma == 0:
+                return 0.0 # Same point
+            cossigma = sinU1 * sinU2 + cosU1 * cosU2 * coslam
+            sigma = atan2(sinsigma, cossigma)
+            sinalpha = cosU1 * cosU2 * sinlam / sinsigma
+            cos2alpha = 1 - sinalpha**2
+            if cos2alpha != 0:
+                cos2sigmam = cossigma - 2 * sinU1 * sinU2 / cos2alpha
+            else:
+                cos2sigmam = 0.0 # Both points on the equator
+            C = wgs84_f / 16 * cos2alpha * (4 + wgs84_f * (4 - 3 * cos2alpha))
+            previous = lam
+            lam = L + (1 - C) * wgs84_f * sinalpha * (sigma + C * sinsigma * (cos2sigmam + C * cossigma * (-1 + 2 * cos2sigmam**2)))
+            if abs(lam - previous) < 1e-12:
+                break
+        else:
+            return self.fallback(lon1, lat1, lon2, lat2)
+        u2 = cos2alpha * (wgs84_a**2 - wgs84_b**2) / wgs84_b**2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        deltasigma = B * sinsigma * (cos2sigmam + B / 4 * (cossigma * (-1 + 2 * cos2sigmam**2) -
+                     B / 6 * cos2sigmam * (-3 + 4 * sinsigma**2) * (-3 + 4 * cos2sigmam**2)))
+        return wgs84_b * A * (sigma - deltasigma)
+
+engines = {'haversine': Haversine,
+           'fast': Equirectangular,
+           'vincenty': Vincenty}
+
+def engine(name = None):
+    # New engine, by default the one in config.py. Raises KeyError for an
+    # unknown name
+    if name is None:
+        name = appconfig['distance']
+    return engines[name]()
+
+def steps(logfile):
+    # (lon1, lat1, lon2, lat2) of each pair of records in the same session
+    steps = []
+    previous = None
+    f = openlog(logfile)
+    try:
+        for line in f:
+            try:
+                info = json.loads(line)
+                point = (info['longitude'], info['latitude'])
+            except (ValueError, KeyError):
+                continue # ignore malformed log entries
+            if info.get('start_record', False):
+                previous = None
+            if previous is not None:
+                steps.append(previous + point)
+            previous = point
+    finally:
+        f.close()
+    return steps
+
+def compare(logfiles, repeat = 3):
+    # Times each engine over the steps of the logs and measures the error of
+    # each step and of the total against vincenty. Returns a dict of results
+    # by engine name
+    pairs = []
+    for logfile in logfiles:
+        try:
+            pairs.extend(steps(logfile))
+        except IOError:
+            print ("Cannot open log file {0}".format(logfile))
+    reference = Vincenty()
+    exact = [reference.distance(*p) for p in pairs]
+    results = {}
+    for name in sorted(engines.keys()):
+        best = None
+        for i in range(repeat):
+            measure = engine(name).distance
+            start = time.time()
+            km = [measure(*p) for p in pairs]
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        errors = [abs(km[i] - exact[i]) * 1000 for i in range(len(pairs))]
+        results[name] = {'steps': len(pairs),
+                         'secs': best,
+                         'km': sum(km),
+                         'max_error_m': max(errors) if len(errors) > 0 else 0.0,
+                         'mean_error_m': sum(errors) / len(errors) if len(errors) > 0 else 0.0}
+    return results
+
+# Main
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the distance engines on logs and report their error against vincenty')
+    parser.add_argument('logs', nargs='+')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    results = compare(args.logs, args.repeat)
+    exact = results['vincenty']['km']
+    print ("{0:10} {1:>10} {2:>12} {3:>12} {4:>12} {5:>12}".format('engine', 'us/step', 'total km', 'total err m', 'max err m', 'mean err m'))
+    for name in sorted(results.keys()):
+        r = results[name]
+        print ("{0:10} {1:10.2f} {2:12.3f} {3:12.2f} {4:12.4f} {5:12.4f}".format(name, r['secs'] * 1e6 / max(r['steps'], 1), r['km'],
+                                                                              (r['km'] - exact) * 1000, r['max_error_m'], r['mean_error_m']))
+    sys.exit(0)
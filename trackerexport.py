@@ -0,0 +1,160 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Export logs as GPX, KML or GeoJSON. Each format is a generator of text
+# reading the log a line at a time, so a log of any size is exported in
+# constant memory and output can be sent as soon as it is made.
+# Sessions are numbered from 1 as on the route page.
+
+import os
+import sys
+import json
+import argparse
+from multiprocessing import Pool
+from xml.sax.saxutils import escape
+from trackerlog import openlog, lognames, logpath
+from config import appconfig
+
+# Fields every format writes. Records without them are skipped
+export_fields = ['latitude', 'longitude', 'altitude', 'gpstime']
+
+def records(logfile, session = None):
+    # Generates (session, record) for each complete record in the log, or
+    # only those in one session. Raises IOError if the log can't be opened
+    f = openlog(logfile)
+    try:
+        current = 0
+        for line in f:
+            try:
+                info = json.loads(line)
+                if not isinstance(info, dict) or not all(field in info for field in export_fields):
+                    continue # Incomplete record would fail part way through the output
+                if info.get('start_record', False) or current == 0:
+                    current += 1
+                if session is not None and current > session:
+                    break # Rest of the log is later sessions
+                if session is None or current == session:
+                    yield (current, info)
+            except ValueError:
+                pass # ignore malformed log entries
+    finally:
+        f.close()
+
+def gpx(logfile, name, session = None):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<gpx version="1.1" creator="gpstracker" xmlns="http://www.topografix.com/GPX/1/1">\n'
+    current = None
+    for (s, info) in records(logfile, session):
+        if s != current:
+            if current is not None:
+                yield '</trkseg></trk>\n'
+            yield '<trk><name>{0}</name><trkseg>\n'.format(escape('{0} session {1}'.format(name, s)))
+            current = s
+        yield '<trkpt lat="{0}" lon="{1}"><ele>{2}</ele><time>{3}</time></trkpt>\n'.format(
+            info['latitude'], info['longitude'], info['altitude'], escape(info['gpstime']))
+    if current is not None:
+        yield '</trkseg></trk>\n'
+    yield '</gpx>\n'
+
+def kml(logfile, name, session = None):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<kml xmlns="http://www.opengis.net/kml/2.2"><Document><name>{0}</name>\n'.format(escape(name))
+    current = None
+    for (s, info) in records(logfile, session):
+        if s != current:
+            if current is not None:
+                yield '</coordinates></LineString></Placemark>\n'
+            yield '<Placemark><name>Session {0}</name><LineString><altitudeMode>absolute</altitudeMode><coordinates>\n'.format(s)
+            current = s
+        yield '{0},{1},{2}\n'.format(info['longitude'], info['latitude'], info['altitude'])
+    if current is not None:
+        yield '</coordinates></LineString></Placemark>\n'
+    yield '</Document></kml>\n'
+
+def geojson(logfile, name, session = None):
+    # A FeatureCollection with a LineString feature for each session
+    yield '{{"type": "FeatureCollection", "name": {0}, "features": ['.format(json.dumps(name))
+    current = None
+    for (s, info) in records(logfile, session):
+        point = '[{0}, {1}, {2}]'.format(info['longitude'], info['latitude'], info['altitude'])
+        if s != current:
+            if current is not None:
+                yield ']}},\n'
+            yield '\n{{"type": "Feature", "properties": {{"session": {0}, "start": {1}}}, "geometry": {{"type": "LineString", "coordinates": [\n'.format(s, json.dumps(info['gpstime']))
+            yield point
+            current = s
+        else:
+            yield ',\n' + point
+    if current is not None:
+        yield ']}}'
+    yield ']}\n'
+
+# Generator and mime type of each format by file extension
+formats = {'gpx': (gpx, 'application/gpx+xml'),
+           'kml': (kml, 'application/vnd.google-earth.kml+xml'),
+           'geojson': (geojson, 'application/geo+json')}
+
+def exportlog(logfile, outfile, fmt):
+    # Write one log to a file. Runs in a worker process so only takes and
+    # returns simple values. Returns the file written or None
+    name = os.path.basename(logfile)
+    try:
+        f = open(outfile + '.tmp', 'w')
+        try:
+            for s in formats[fmt][0](logfile, name):
+                f.write(s)
+        finally:
+            f.close()
+        os.rename(outfile + '.tmp', outfile)
+    except (IOError, OSError) as e:
+        print ("Error exporting {0}: {1}".format(logfile, e))
+        return None
+    return outfile
+
+def exportlogs(logdir, outdir, fmt, start = None, end = None, processes = None):
+    # Export all logs dated between start and end inclusive, as YYYYMMDD,
+    # using a pool of processes. Returns the files written
+    prefix = appconfig['prefix']
+    jobs = []
+    for name in lognames(logdir, prefix):
+        date = name[len(prefix):]
+        if (start is None or date >= start) and (end is None or date <= end):
+            jobs.append((logpath(logdir, name), os.path.join(outdir, '{0}.{1}'.format(name, fmt)), fmt))
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    pool = Pool(processes)
+    try:
+        results = [pool.apply_async(exportlog, job) for job in jobs]
+        written = [r.get() for r in results]
+    finally:
+        pool.close()
+        pool.join()
+    return [f for f in written if f is not None]
+
+# Main
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export tracker logs')
+    parser.add_argument('outdir', help='directory to write exported logs to')
+    parser.add_argument('--format', choices=sorted(formats.keys()), default='gpx')
+    parser.add_argument('--from', dest='start', metavar='YYYYMMDD', help='first day to export')
+    parser.add_argument('--to', dest='end', metavar='YYYYMMDD', help='last day to export')
+    parser.add_argument('--logdir', default=appconfig['logdir'])
+    parser.add_argument('--processes', type=int, default=None, help='default is one per CPU')
+    args = parser.parse_args()
+
+    written = exportlogs(args.logdir, args.outdir, args.format, args.start, args.end, args.processes)
+    print ("Exported {0} logs to {1}".format(len(written), args.outdir))
+    if len(written) == 0:
+        sys.exit(1)
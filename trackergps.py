@@ -16,18 +16,283 @@ import gps
 import dateutil.parser
 import time
 import json
+import os
+import errno
+import random
+import select
+import socket
+from array import array
 from datetime import datetime
+from operator import itemgetter, attrgetter
+from collections import namedtuple
 from threading import Thread, Lock
 from math import sqrt, pi, sin, cos, tan, atan2, radians, asin, floor, ceil
 from config import appconfig
+from trackergpsd import GPSDClient
+from trackerdistance import engine, haversine
+from trackertrace import trace
+from trackerlog import openlog, checkpointpath
 
 kmtomiles = 0.621371
 
+gpstrace = trace.category('gps') # gpsd connection and the GPS duty cycle
+logtrace = trace.category('log') # Reading and writing logs
+distancetrace = trace.category('distance') # Each step between fixes
+
+# Fields of a log record in the order they're written, with the value used
+# when a record is missing one
+fix_defaults = [('gpstime', ''),
+                ('timesec', None), # Worked out from gpstime if missing
+                ('latitude', 0),
+                ('longitude', 0),
+                ('error_latitude', 0),
+                ('error_longitude', 0),
+                ('altitude', 0),
+                ('error_altitude', 0),
+                ('speed', 0),
+                ('error_speed', 0),
+                ('climb', 0),
+                ('error_climb', 0),
+                ('start_record', False)]
+fix_fields = [f[0] for f in fix_defaults]
+fix_values = itemgetter(*fix_fields)
+# JSON of a record. Numbers are written with repr as json does
+fix_format = '{{' + ', '.join(['"{0}": {{{1}}}'.format(fix_fields[i], i) for i in range(len(fix_fields))]) + '}}'
+
+class Fix(namedtuple('Fix', fix_fields)):
+    'One GPS fix as logged. Fixes are never changed so are shared rather than copied'
+    __slots__ = ()
+
+    @classmethod
+    def fromdict(cls, d):
+        # Raises ValueError if a number field isn't a number
+        try:
+            values = fix_values(d)
+            sum(values[1:-1]) # TypeError unless every number field is a number
+            return tuple.__new__(cls, values)
+        except (KeyError, TypeError):
+            pass # Older or damaged record
+        values = [d.get(f, default) for (f, default) in fix_defaults]
+        try:
+            if values[1] is None:
+                # Old logs only have the time as a string
+                values[1] = TrackerGPS.time_to_sec(dateutil.parser.parse(values[0]).time())
+            values[1:-1] = [float(v) for v in values[1:-1]]
+        except (TypeError, OverflowError):
+            raise ValueError("Log record has a field which isn't a number")
+        return cls._make(values)
+
+    @classmethod
+    def fromjson(cls, s):
+        # Raises ValueError if s isn't a log record
+        d = json.loads(s)
+        if not isinstance(d, dict):
+            raise ValueError("Log record isn't an object")
+        return cls.fromdict(d)
+
+    def tojson(self):
+        values = list(map(repr, self[1:-1]))
+        return fix_format.format(json.dumps(self.gpstime), *values + ['true' if self.start_record else 'false'])
+
+    def todict(self):
+        return dict(zip(fix_fields, self))
+
+# Fix with nothing known
+blank_fix = Fix._make([default for (f, default) in fix_defaults])._replace(timesec=0, start_record=True)
+
+# gpsd TPV keys and the log record fields they're held in
+tpv_fields = [('lat', 'latitude'),
+              ('lon', 'longitude'),
+              ('epy', 'error_latitude'),
+              ('epx', 'error_longitude'),
+              ('alt', 'altitude'),
+              ('epv', 'error_altitude'),
+              ('speed', 'speed'),
+              ('eps', 'error_speed'),
+              ('climb', 'climb'),
+              ('epc', 'error_climb')]
+tpv_indexes = [(key, fix_fields.index(field)) for (key, field) in tpv_fields]
+
+def parse_gpstime(s):
+    # gpsd times are YYYY-MM-DDTHH:MM:SS[.sss]Z which is read without
+    # dateutil. Anything else is left to dateutil
+    try:
+        if s[-1] == 'Z' and s[10] == 'T':
+            return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]), int(s[11:13]), int(s[14:16]), int(s[17:19]))
+    except (ValueError, IndexError):
+        pass
+    return dateutil.parser.parse(s)
+
+def update_bounds(bounds, latitude, longitude):
+    if bounds is None:
+        bounds = {}
+        bounds['minlat'] = latitude
+        bounds['maxlat'] = latitude
+        bounds['minlon'] = longitude
+        bounds['maxlon'] = longitude
+        return bounds
+    
+    bounds['minlat'] = min(bounds['minlat'], latitude)
+    bounds['minlon'] = min(bounds['minlon'], longitude)
+    bounds['maxlon'] = max(bounds['maxlon'], longitude)
+    bounds['maxlat'] = max(bounds['maxlat'], latitude)
+
+    return bounds
+
+def merge_bounds(bounds, other):
+    # Bounds covering both bounds and other. Either may be None
+    if other is None:
+        return bounds
+    bounds = update_bounds(bounds, other['minlat'], other['minlon'])
+    return update_bounds(bounds, other['maxlat'], other['maxlon'])
+
+class TrackPoint(object):
+    'Read only view of one point of a SessionTrack, indexed like a log record'
+    __slots__ = ['track', 'index']
+
+    def __init__(self, track, index):
+        self.track = track
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.track.columns[key][self.index]
+
+    def get(self, key, default = None):
+        if key in self.track.columns:
+            return self[key]
+        return default
+
+class SessionTrack(object):
+    'Points of a session held column by column in typed arrays'
+
+    # Log record fields kept for each point
+    fields = ['timesec', 'latitude', 'longitude', 'altitude', 'speed', 'climb',
+              'error_latitude', 'error_longitude', 'error_altitude', 'error_speed']
+
+    values = attrgetter(*fields)
+
+    def __init__(self):
+        self.arrays = [array('d') for f in self.fields]
+        self.columns = dict(zip(self.fields, self.arrays))
+        self.bounds = None # Kept up to date as points are added
+
+    def __len__(self):
+        return len(self.columns['latitude'])
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Track point out of range")
+        return TrackPoint(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield TrackPoint(self, i)
+
+    def append(self, info):
+        # Add a Fix. This is called for every point of a log so
+        # avoids a python loop over the fields
+        list(map(array.append, self.arrays, self.values(info)))
+
+        lat = info.latitude
+        lon = info.longitude
+        bounds = self.bounds
+        if bounds is None:
+            self.bounds = update_bounds(None, lat, lon)
+            return
+        if lat < bounds['minlat']: bounds['minlat'] = lat
+        elif lat > bounds['maxlat']: bounds['maxlat'] = lat
+        if lon < bounds['minlon']: bounds['minlon'] = lon
+        elif lon > bounds['maxlon']: bounds['maxlon'] = lon
+
+    def copy(self):
+        track = SessionTrack()
+        track.arrays = [a[:] for a in self.arrays]
+        track.columns = dict(zip(self.fields, track.arrays))
+        if self.bounds is not None:
+            track.bounds = self.bounds.copy()
+        return track
+
+class SplitAccumulator(object):
+    'Accumulates values into fixed size buckets of a running position'
+
+    def __init__(self, size, lower_is_faster = True):
+        # Position is a running total such as km, miles, seconds or metres climbed.
+        # Each bucket covers size units of the position. lower_is_faster is used
+        # to pick the fastest bucket, i.e. time per km is faster when lower but
+        # distance per hour is faster when higher
+        self.size = float(size)
+        self.lower_is_faster = lower_is_faster
+        self.values = array('d')
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def index(self, position):
+        return int(floor(position / self.size))
+
+    def add(self, position, value):
+        # Add value to the bucket holding position. Missing buckets
+        # up to position are created empty
+        i = self.index(position)
+        if i < 0:
+            return
+        if i >= len(self.values):
+            self.values.extend(array('d', [0.0]) * (i + 1 - len(self.values)))
+        self.values[i] += value
+
+    def completed(self):
+        # Last bucket is still being filled and so is not complete
+        return max(len(self.values) - 1, 0)
+
+    def current(self):
+        # Value of the bucket currently being filled
+        if len(self.values) == 0:
+            return 0.0
+        return self.values[-1]
+
+    def last(self, count, complete = True):
+        # List of (index, value) for the last count buckets, newest first
+        end = len(self.values)
+        if complete:
+            end = self.completed()
+        start = max(end - count, 0)
+        return [(i, self.values[i]) for i in range(end - 1, start - 1, -1)]
+
+    def fastest(self, complete = True):
+        # (index, value) of the fastest bucket or None if there are no buckets
+        end = len(self.values)
+        if complete:
+            end = self.completed()
+        if end == 0:
+            return None
+        if self.lower_is_faster:
+            best = min(range(end), key=self.values.__getitem__)
+        else:
+            best = max(range(end), key=self.values.__getitem__)
+        return (best, self.values[best])
+
+    def clear(self):
+        del self.values[:]
+
+    def tolist(self):
+        return self.values.tolist()
+
+    def fromlist(self, values):
+        self.values = array('d', values)
+
 class GPSSummary(object):
     'Provides a summary record for a GPS log file'
 
     def __init__(self):
-        self.dbg = appconfig['debug']
+        self.engine = engine() # Distance between fixes
         self.reset()
         
     def reset(self):
@@ -38,40 +303,65 @@ class GPSSummary(object):
         self.sigma_lon_error_metres = 0 # Avg error from GPS
         self.sigma_lat_error_metres = 0 # Avg error from GPS
         self.km_per_hour = 0 # Avg speed
-        self.split_time_km = [] # Each km is an entry with time taken
-        self.split_time_miles = [] # Each mile is an entry with the time taken
-        self.split_km_hour = [] # Each entry is an hour with distance travelled
-        self.split_mile_hour = []
-        self.elevation_per_km = [] # Height covered per km
+        self.split_time_km = SplitAccumulator(1) # Each km is an entry with time taken
+        self.split_time_miles = SplitAccumulator(1) # Each mile is an entry with the time taken
+        # Each entry is a period of time with distance travelled
+        self.split_km_hour = SplitAccumulator(appconfig['split_minutes'] * 60, lower_is_faster=False)
+        self.split_mile_hour = SplitAccumulator(appconfig['split_minutes'] * 60, lower_is_faster=False)
+        self.elevation_per_km = SplitAccumulator(1, lower_is_faster=False) # Height climbed per km
+        self.split_time_climb = SplitAccumulator(appconfig['split_climb_metres']) # Time taken per climb
+        self.climb_metres = 0.0 # Total height climbed
         self.min_height = 0
         self.max_height = 0
         self.sigma_alt_error_metres = 0
         self.sessions_recorded = 0 # Times that the recording was started
-        self.log_items = [] # only used by web interface to hold a cache of log
+        self.log_items = SessionTrack() # only used by web interface to hold a cache of log
         
         self.longlatheld = None
         self.previnfo = None
-        self.info = {'gpstime':'',
-                     'timesec':0,
-                     'latitude':0,
-                     'longitude':0,
-                     'error_latitude':0,
-                     'error_longitude':0,
-                     'altitude':0,
-                     'error_altitude':0,
-                     'speed':0,
-                     'error_speed':0,
-                     'climb':0,
-                     'error_climb':0,
-                     'start_record':True}
+        self.info = blank_fix
+
+    # Summary attributes saved in a checkpoint. log_items is only a cache for the web
+    # interface so isn't included
+    state_attributes = ['records', 'km', 'mile', 'secs', 'sigma_lon_error_metres',
+                        'sigma_lat_error_metres', 'sigma_alt_error_metres', 'km_per_hour',
+                        'climb_metres', 'min_height', 'max_height', 'sessions_recorded',
+                        'longlatheld', 'previnfo', 'info']
+    state_splits = ['split_time_km', 'split_time_miles', 'split_km_hour', 'split_mile_hour',
+                    'elevation_per_km', 'split_time_climb']
+    state_fixes = ['longlatheld', 'previnfo', 'info'] # Saved as dicts
+
+    def getstate(self):
+        # All the summary data as a dict which can be serialised with json
+        state = dict([(a, getattr(self, a)) for a in self.state_attributes])
+        for a in self.state_splits:
+            state[a] = {'size':getattr(self, a).size, 'values':getattr(self, a).tolist()}
+        for a in self.state_fixes:
+            if state[a] is not None:
+                state[a] = state[a].todict()
+        return state
+
+    def setstate(self, state):
+        # Restore from getstate. Raises KeyError or ValueError if the state
+        # doesn't match this summary
+        for a in self.state_splits:
+            if state[a]['size'] != getattr(self, a).size:
+                raise ValueError("Split size has changed for {0}".format(a))
+        for a in self.state_attributes:
+            setattr(self, a, state[a])
+        for a in self.state_fixes:
+            if state[a] is not None:
+                setattr(self, a, Fix.fromdict(state[a]))
+        for a in self.state_splits:
+            getattr(self, a).fromlist(state[a]['values'])
 
     @property
     def gps_serial_data(self):
-        return json.dumps(self.info)
+        return self.info.tojson()
     
     @gps_serial_data.setter
     def gps_serial_data(self, s):
-        self.info = json.loads(s)
+        self.info = Fix.fromjson(s)
 
     @staticmethod
     def haversine(lon1, lat1, lon2, lat2):
@@ -79,133 +369,196 @@ class GPSSummary(object):
         Calculate the great circle distance between two points 
         on the earth (specified in decimal degrees)
         """
-        # convert decimal degrees to radians
-        lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-        # haversine formula
-        dlon = lon2 - lon1
-        dlat = lat2 - lat1
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * asin(sqrt(a))
-        # Radius calculation can be improved with https://rechneronline.de/earth-radius/
-        # Radius changes depending on latitude. 
-        #km = 6367 * c # Halfway radius
-        km = 6371 * c # Avg radius
-        return km
+        # Steps between fixes are measured by the engine chosen in
+        # config.py, see trackerdistance.py
+        return haversine(lon1, lat1, lon2, lat2)
 
     @staticmethod
     def iswithinerror(dis_km, info1, info2):
             # Check the error from GPS. Only include distances outside the largest error result. This is really rough
             # and unscientific but should exclude small distances which are due to wandering GPS coordinates
-            error1 = max(info1['error_longitude'], info1['error_latitude'])
-            error2 = max(info2['error_longitude'], info2['error_latitude'])
-            #if self.dbg:
-            #    print ("From ({0}, {1}) to ({2}, {3}), distance delta is {4:.3f}, error {5:.3f}".format(info1['longitude'],
-            #                                                                                            info1['latitude'],
-            #                                                                                            info2['longitude'],
-            #                                                                                            info2['latitude'],
-            #                                                                                            dis_km,
-            #                                                                                            (error1+error2)/1000))
+            error1 = max(info1.error_longitude, info1.error_latitude)
+            error2 = max(info2.error_longitude, info2.error_latitude)
+            if distancetrace.debugging:
+                distancetrace.debug("From ({0}, {1}) to ({2}, {3}), distance delta is {4:.3f}, error {5:.3f}",
+                                    info1.longitude, info1.latitude, info2.longitude, info2.latitude,
+                                    dis_km, (error1+error2)/1000)
 
             return dis_km < (((error1 + error2)/4) /1000)
         
     def calculate_distance(self):
         global kmtomiles
-        if self.longlatheld is not None:
+        info = self.info
+        held = self.longlatheld
+        if held is not None:
             # Only if another record has been written as held can this code run
 
             # Compare previous long and lat to calculate distance
-            deltakm = self.haversine(self.longlatheld['longitude'], self.longlatheld['latitude'], self.info['longitude'], self.info['latitude'])
+            deltakm = self.engine.distance(held.longitude, held.latitude, info.longitude, info.latitude)
 
-            if not self.iswithinerror(deltakm, self.longlatheld, self.info):
+            if not self.iswithinerror(deltakm, held, info):
                 # Distance is outside the error so attribute to distance covered
                 # Note the log entry used for this distance calculation
                 self.km += deltakm
                 self.mile += deltakm * kmtomiles
 
-                # Create entries in km split time list
-                while len(self.split_time_km) < self.km:
-                    self.split_time_km.append(0)
-                    if self.dbg: print ("Creating split km record {0}".format(len(self.split_time_km)))
-
-                # Create entries in mile split time list
-                while len(self.split_time_miles) < self.km * kmtomiles:
-                    self.split_time_miles.append(0)
-                    if self.dbg: print ("Creating split mile record {0}".format(len(self.split_time_miles)))
-
                 # This works unless rolling over midnight where timesec will reset.
-                timedelta = self.info['timesec'] - self.longlatheld['timesec']
+                timedelta = info.timesec - held.timesec
+                if distancetrace.debugging: distancetrace.debug("Time delta is {0}sec", timedelta)
+
+                # Attribute the time and distance to the split each finished in
                 self.secs += timedelta
-                hours = self.secs / 3600.0
-                if self.dbg: print ("Time delta is {0}sec".format(timedelta))
-                while len(self.split_km_hour) <= hours:
-                    self.split_km_hour.append(0)
-                    if self.dbg: print ("Creating split km time record {0}".format(len(self.split_km_hour)))
-                    
-                while len(self.split_mile_hour) <= hours:
-                    self.split_mile_hour.append(0)
-                    if self.dbg: print ("Creating split mile time record {0}".format(len(self.split_mile_hour)))
+                self.split_km_hour.add(self.secs, deltakm)
+                self.split_mile_hour.add(self.secs, deltakm * kmtomiles)
+                self.split_time_km.add(self.km, timedelta)
+                self.split_time_miles.add(self.mile, timedelta)
 
-                # Calculate time taken between points
-                try:
-                    self.split_km_hour[int(floor(hours))] += deltakm
-                    self.split_mile_hour[int(floor(hours))] += deltakm * kmtomiles
-                    self.split_time_km[int(floor(self.km))] += self.info['timesec'] - self.longlatheld['timesec']
-                    self.split_time_miles[int(floor(self.km * kmtomiles))] += self.info['timesec'] - self.longlatheld['timesec']
-                except KeyError:
-                    # May be an old log file, parse date/time string and calculate difference in seconds
-                    # Remove this soon! Not applied for miles
-                    self.split_time_km[int(floor(self.km))] += TrackerGPS.time_to_sec(dateutil.parser.parse(self.info['gpstime']).time()) - TrackerGPS.time_to_sec(dateutil.parser.parse(self.longlatheld['gpstime']).time())
-
-                if self.dbg:
-                    print ("Accumulated time in split km {0} is {1:.2f}".format(int(ceil(self.km)), self.split_time_km[int(floor(self.km))]))
-                    print ("Accumulated time in split mile {0} is {1:.2f}".format(int(ceil(self.km * kmtomiles)), self.split_time_miles[int(floor(self.km * kmtomiles))]))
-
-                self.longlatheld = self.info.copy()
+                # Only height gained counts as climb
+                climb = info.altitude - held.altitude
+                if climb > 0:
+                    self.elevation_per_km.add(self.km, climb)
+                    self.climb_metres += climb
+                    self.split_time_climb.add(self.climb_metres, timedelta)
+
+                if distancetrace.debugging:
+                    distancetrace.debug("Accumulated time in split km {0} is {1:.2f}", self.split_time_km.index(self.km) + 1, self.split_time_km.current())
+                    distancetrace.debug("Accumulated time in split mile {0} is {1:.2f}", self.split_time_miles.index(self.mile) + 1, self.split_time_miles.current())
+
+                self.longlatheld = info
             else:
-                if self.dbg: print ("Distance delta is too small {0:.3f}".format(deltakm))
+                if distancetrace.debugging: distancetrace.debug("Distance delta is too small {0:.3f}", deltakm)
                 pass
         else:
             # This is a section which is run for the first GPS entry for a session
-            self.longlatheld = self.info.copy() # just copy the whole record
+            self.longlatheld = info # Fixes are shared, not copied
         
     def commit_data(self):
         # This confirms that the record is final and to compute
         # the summary data
-        try:
-            if self.info['start_record'] == True:
-                self.sessions_recorded += 1
-                self.previnfo = None
-                self.longlatheld = None
-        except KeyError:
-            # Missing from this record, ignore
-            pass
+        info = self.info
+        if info.start_record:
+            self.sessions_recorded += 1
+            self.previnfo = None
+            self.longlatheld = None
         
         self.calculate_distance()
         
         if self.records == 0:
             # This is a section which is run for the first GPS entry
-            self.min_height = self.info['altitude']
-            self.max_height = self.info['altitude']
+            self.min_height = info.altitude
+            self.max_height = info.altitude
 
         # Check if max or min altitudes need updating
-        if self.min_height > self.info['altitude']:
-            self.min_height = self.info['altitude']
-        if self.max_height < self.info['altitude']:
-            self.max_height = self.info['altitude']
-
-        self.sigma_lon_error_metres += self.info['error_longitude']
-        self.sigma_lat_error_metres += self.info['error_latitude']
-        self.sigma_alt_error_metres += self.info['error_altitude']
+        if self.min_height > info.altitude:
+            self.min_height = info.altitude
+        if self.max_height < info.altitude:
+            self.max_height = info.altitude
+
+        self.sigma_lon_error_metres += info.error_longitude
+        self.sigma_lat_error_metres += info.error_latitude
+        self.sigma_alt_error_metres += info.error_altitude
         
-        self.previnfo = self.info.copy()
+        self.previnfo = info
         self.records += 1
         
+class DutyCycle(object):
+    'Rests the GPS whilst the tracker is stationary'
+
+    # States in the order published in the status record
+    states = ['off', 'tracking', 'resting', 'acquiring']
+
+    def __init__(self):
+        self.enabled = appconfig['duty_cycle']
+        self.stationary_secs = appconfig['stationary_secs'] # Time within stationary_metres before resting
+        self.stationary_metres = appconfig['stationary_metres']
+        self.rest_secs = appconfig['rest_secs'] # Time the GPS is off between checks for movement
+        self.lowpower_rest_secs = appconfig['lowpower_rest_secs'] # Used instead whilst on the Low power screen
+        self.acquire_secs = appconfig['acquire_secs'] # Longest wait for a fix after resting
+        self.lowpower = False
+        self.onchange = None # Called with (state, previous state, seconds in previous state, reason)
+        self.totals = dict([(state, 0.0) for state in self.states]) # Seconds in each state
+        self.transitions = 0
+        self.state = 'off'
+        self.since = time.time()
+        self.anchor = None # (latitude, longitude, time) the tracker has stayed near
+
+    def reset(self, state, now = None):
+        # Start again in state when the GPS is started or stopped
+        if now is None:
+            now = time.time()
+        self.totals[self.state] += now - self.since
+        self.state = state
+        self.since = now
+        self.anchor = None
+
+    def change(self, state, now, reason):
+        previous = self.state
+        spent = now - self.since
+        self.totals[previous] += spent
+        self.transitions += 1
+        self.state = state
+        self.since = now
+        gpstrace.info("GPS {0} after {1:.0f}s {2}: {3}", state, spent, previous, reason)
+        if self.onchange is not None:
+            self.onchange(state, previous, spent, reason)
+
+    def moved(self, latitude, longitude):
+        km = GPSSummary.haversine(self.anchor[1], self.anchor[0], longitude, latitude)
+        return km * 1000 > self.stationary_metres
+
+    def fix(self, latitude, longitude, now):
+        # Take in a position. Called for every fix
+        if not self.enabled:
+            return
+        if self.state == 'acquiring':
+            if self.moved(latitude, longitude):
+                self.anchor = (latitude, longitude, now)
+                self.change('tracking', now, 'moved')
+            else:
+                self.change('resting', now, 'still stationary')
+        elif self.state == 'tracking':
+            if self.anchor is None or self.moved(latitude, longitude):
+                self.anchor = (latitude, longitude, now)
+            elif now - self.anchor[2] >= self.stationary_secs:
+                self.change('resting', now, 'stationary for {0:.0f}s'.format(now - self.anchor[2]))
+
+    @property
+    def rest(self):
+        if self.lowpower:
+            return self.lowpower_rest_secs
+        return self.rest_secs
+
+    def timeout(self, now):
+        # Seconds until the state changes without a fix, or None
+        if self.state == 'resting':
+            return max(self.since + self.rest - now, 0)
+        if self.state == 'acquiring':
+            return max(self.since + self.acquire_secs - now, 0)
+        return None
+
+    def awake(self, now):
+        # True if the GPS should be running now
+        if self.state == 'resting' and now - self.since >= self.rest:
+            self.change('acquiring', now, 'checking for movement')
+        elif self.state == 'acquiring' and now - self.since >= self.acquire_secs:
+            # Without a fix it isn't known if the tracker moved
+            self.anchor = None
+            self.change('tracking', now, 'no fix')
+        return self.state != 'resting'
+
+    def seconds(self, state, now = None):
+        # Total time spent in a state including the current one
+        total = self.totals[state]
+        if self.state == state:
+            total += (now if now is not None else time.time()) - self.since
+        return total
+
 class TrackerGPS(Thread):
     'GPS wrapper class with worker thread to read GPS buffer'
     
     def __init__(self):
         Thread.__init__(self)
-        self.gps = gps.gps()
+        self.gps = None # Connected to gpsd on first start
         self.time = datetime.now()
         self.error_time = 0
         self.mode = 0
@@ -217,10 +570,30 @@ class TrackerGPS(Thread):
         self.logdir = appconfig['logdir']
         self.logfilename = appconfig['prefix']
         self.loghandle = None
+        self.newsession = True # Next record written starts a session
         self.lastlogwrite = 0
         self.logperiod = 20 # seconds
+        self.checkpointperiod = appconfig['checkpoint_records'] # records between checkpoints
+        self.uncheckpointed = 0
         self.__lock = Lock()
         self.data = GPSSummary()
+        self.publisher = None # Set to a LivePublisher to send each fix
+        self.status = None # Set to a StatusWriter to share the state with other processes
+        # The reader thread owns the gpsd connection. start, stop and
+        # terminate only set what's wanted and wake it through a pipe
+        self.watching = False # Reports wanted from gpsd
+        self.watched = False # Reports asked for on the current connection
+        self.wakeup = None # Pipe opened when the reader starts
+        self.__wakeupsend = None
+        self.timeout = appconfig['gpsd_timeout'] # seconds without a report before reconnecting
+        self.backoff = appconfig['gpsd_backoff'] # (first, longest) seconds between connection attempts
+        self.failures = 0 # Connection attempts failed in a row
+        self.connections = 0 # Successful connections to gpsd
+        self.stalls = 0 # Connections dropped as gpsd stopped sending
+        self.disconnected_secs = 0.0 # Time wanting reports whilst not connected
+        self.disconnected = None # time.time() the connection was lost
+        self.duty = DutyCycle()
+        self.duty.onchange = self.dutychanged
 
     @staticmethod
     def time_to_sec(t):
@@ -244,49 +617,219 @@ class TrackerGPS(Thread):
                 try:
                     self.loghandle = open(filename, 'a')
                     self.loghandle.write('\n') # Start new line to avoid incomplete previous log lines
-                    self.data.info['start_record'] = True
+                    self.newsession = True # First record written starts a session
                 except IOError:
                     # Cannot open the file.
-                    print ("Cannot open the log file {0}".format(filename))
+                    logtrace.error("Cannot open the log file {0}", filename)
                     pass
         self.__lock.release() 
             
-    def run(self):
-        while not self.__quit:
+    def connect(self):
+        # Client for gpsd chosen in config.py. Both read from a non-blocking
+        # socket so the reader thread never blocks in the client
+        if appconfig['gpsd_client'] == 'raw':
+            return GPSDClient()
+        client = gps.gps(appconfig['gpsd_host'], appconfig['gpsd_port'])
+        client.sock.setblocking(False)
+        return client
+
+    def report(self, gpsdat):
+        # Take in a TPV or SKY report from either gpsd client. Both support
+        # get so each field is looked up once without hasattr
+        cls = gpsdat['class']
+        if cls == 'TPV':
+            # A new Fix starting from the last one as a report may not
+            # have every field. Locked as loadlog may be replacing data
+            self.__lock.acquire()
             try:
-                gpsdat = self.gps.next()
-                if gpsdat['class'] == 'TPV':
-                    if hasattr(gpsdat, 'time'):
-                        self.data.info['gpstime'] = gpsdat.time
-                        self.time = dateutil.parser.parse(gpsdat.time)
-                        self.data.info['timesec'] = self.time_to_sec(self.time.time())
-                    if hasattr(gpsdat, 'ept'): self.data.error_time = float(gpsdat.ept)
-                    if hasattr(gpsdat, 'mode'): self.mode = int(gpsdat.mode)
-                    if hasattr(gpsdat, 'lat'): self.data.info['latitude'] = float(gpsdat.lat)
-                    if hasattr(gpsdat, 'lon'): self.data.info['longitude'] = float(gpsdat.lon)
-                    if hasattr(gpsdat, 'epy'): self.data.info['error_latitude'] = float(gpsdat.epy)
-                    if hasattr(gpsdat, 'epx'): self.data.info['error_longitude'] = float(gpsdat.epx)
-                    if hasattr(gpsdat, 'alt'): self.data.info['altitude'] = float(gpsdat.alt)
-                    if hasattr(gpsdat, 'epv'): self.data.info['error_altitude'] = float(gpsdat.epv)
-                    if hasattr(gpsdat, 'speed'): self.data.info['speed'] = float(gpsdat.speed)
-                    if hasattr(gpsdat, 'eps'): self.data.info['error_speed'] = float(gpsdat.eps)
-                    if hasattr(gpsdat, 'climb'): self.data.info['climb'] = float(gpsdat.climb)
-                    if hasattr(gpsdat, 'epc'): self.data.info['error_climb'] = float(gpsdat.epc)
-                if hasattr(gpsdat, 'satellites'): # Read sky data
-                    self.satellites = len(gpsdat.satellites)
+                values = list(self.data.info)
+                t = gpsdat.get('time')
+                if t is not None:
+                    values[0] = t
+                    self.time = parse_gpstime(t)
+                    values[1] = self.time_to_sec(self.time.time())
+                value = gpsdat.get('ept')
+                if value is not None: self.data.error_time = float(value)
+                value = gpsdat.get('mode')
+                if value is not None: self.mode = int(value)
+                for (key, index) in tpv_indexes:
+                    value = gpsdat.get(key)
+                    if value is not None:
+                        values[index] = float(value)
+                info = Fix._make(values)
+                self.data.info = info
+            finally:
+                self.__lock.release()
+            if self.mode >= 2 and gpsdat.get('lat') is not None:
+                self.duty.fix(info.latitude, info.longitude, time.time())
+            if self.publisher is not None and self.mode >= 2:
+                self.publish()
+        elif cls == 'SKY':
+            # Newer gpsd counts the satellites for us
+            if gpsdat.get('nSat') is not None and gpsdat.get('uSat') is not None:
+                self.satellites = int(gpsdat['nSat'])
+                self.satellites_used = int(gpsdat['uSat'])
+            else:
+                satellites = gpsdat.get('satellites')
+                if satellites is not None: # Read sky data
+                    self.satellites = len(satellites)
                     self.satellites_used = 0
-                    for sat in gpsdat.satellites:
-                        if hasattr(sat, 'used'):
-                            if sat.used:
-                                self.satellites_used += 1
-                        
-            except KeyError:
+                    for sat in satellites:
+                        if sat.get('used'):
+                            self.satellites_used += 1
+
+    def wake(self):
+        # Interrupt the reader's wait. Writes are dropped if the pipe is
+        # full as the reader will wake anyway. Nothing to wake before the
+        # reader has started
+        if self.__wakeupsend is None:
+            return
+        try:
+            os.write(self.__wakeupsend, b'.')
+        except OSError:
+            pass
+
+    def disconnect(self):
+        if self.gps is not None:
+            try:
+                self.gps.close()
+            except (socket.error, OSError):
                 pass
-            except StopIteration:
-                # Attempt to restart
-                self.gps = gps.gps()
-                self.gps.stream(gps.WATCH_ENABLE | gps.WATCH_NEWSTYLE)
-            
+            self.gps = None
+            self.watched = False
+            self.disconnected = time.time()
+
+    def reconnect(self):
+        # Connect to gpsd, waiting longer after each failure with jitter so
+        # restarting gpsd isn't hit by every client at once. Returns False
+        # if it failed or the wait was interrupted
+        if self.failures > 0:
+            delay = min(self.backoff[0] * (2 ** (self.failures - 1)), self.backoff[1])
+            delay = random.uniform(delay / 2.0, delay)
+            if self.wait([], delay) is None:
+                return False # Woken to stop or quit
+        try:
+            self.gps = self.connect()
+        except (socket.error, OSError) as e:
+            self.failures += 1
+            gpstrace.warning("Cannot connect to gpsd, attempt {0}: {1}", self.failures, e)
+            return False
+        self.failures = 0
+        self.connections += 1
+        gpstrace.info("Connected to gpsd, connection {0}", self.connections)
+        if self.disconnected is not None:
+            self.disconnected_secs += time.time() - self.disconnected
+            self.disconnected = None
+        return True
+
+    def wait(self, sockets, timeout):
+        # Wait until a socket can be read or timeout. Returns the sockets
+        # which can be read or None if woken through the wakeup pipe
+        (r, w, x) = select.select(sockets + [self.wakeup], [], [], timeout)
+        if self.wakeup in r:
+            os.read(self.wakeup, 512)
+            return None
+        return r
+
+    @property
+    def reconnects(self):
+        return max(self.connections - 1, 0)
+
+    @property
+    def downtime(self):
+        # Seconds spent disconnected whilst reports were wanted
+        if self.disconnected is not None:
+            return self.disconnected_secs + time.time() - self.disconnected
+        return self.disconnected_secs
+
+    def nextreport(self):
+        # The next report from the client or None if a whole one hasn't
+        # been read. The gps module's next() returns the previous report
+        # again when it only reads part of one, so its read() is used and
+        # the line it took is checked
+        if isinstance(self.gps, GPSDClient):
+            return self.gps.next()
+        pending = len(self.gps.linebuffer)
+        if self.gps.read() == -1:
+            raise StopIteration
+        response = self.gps.response
+        if not response:
+            # Cleared when only part of a report has been read. If nothing
+            # more arrived gpsd closed the connection part way through one
+            if len(self.gps.linebuffer) == pending:
+                raise StopIteration
+            return None
+        # Only whole JSON reports are unpacked into data
+        if response.startswith('{') and response.endswith('}\r\n'):
+            return self.gps.data
+        return None
+
+    def read(self):
+        # Wait for and take in one report. Returns True if one was read
+        if b'\n' not in self.gps.linebuffer:
+            # No whole report buffered by the client
+            ready = self.wait([self.gps.sock], self.timeout)
+            if ready is None:
+                return False # Woken to stop or quit
+            if len(ready) == 0:
+                # Nothing from gpsd for too long so try a new connection
+                self.stalls += 1
+                gpstrace.warning("Nothing from gpsd for {0}s, reconnecting", self.timeout)
+                self.disconnect()
+                return False
+        try:
+            gpsdat = self.nextreport()
+            if gpsdat is None:
+                return False # Only part of a report has arrived
+            self.report(gpsdat)
+        except KeyError:
+            pass
+        except StopIteration:
+            gpstrace.warning("gpsd closed the connection")
+            self.disconnect() # gpsd went away
+            return False
+        except (socket.error, OSError) as e:
+            if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False # Only part of a report has arrived
+            gpstrace.warning("Lost the gpsd connection: {0}", e)
+            self.disconnect()
+            return False
+        return True
+
+    def run(self):
+        while not self.__quit:
+            now = time.time()
+            if not self.watching or not self.duty.awake(now):
+                # Stopped, or resting whilst stationary
+                if self.gps is not None and self.watched:
+                    try:
+                        self.gps.stream(gps.WATCH_DISABLE)
+                        self.watched = False
+                    except (socket.error, OSError):
+                        self.disconnect()
+                if self.disconnected is not None:
+                    self.disconnected_secs += time.time() - self.disconnected
+                    self.disconnected = None
+                if self.watching:
+                    self.wait([], self.duty.timeout(now))
+                else:
+                    self.wait([], None) # Until started or terminated
+                continue
+            if self.gps is None:
+                if self.disconnected is None:
+                    self.disconnected = time.time()
+                if not self.reconnect():
+                    continue
+            if not self.watched:
+                try:
+                    self.gps.stream(gps.WATCH_ENABLE | gps.WATCH_NEWSTYLE)
+                    self.watched = True
+                except (socket.error, OSError):
+                    self.disconnect()
+                    continue
+            if not self.read():
+                continue
+
             # For demo purposes mess up the lon and lat
             #self.data.latitude -= 1
             #self.data.longitude += 0.1
@@ -294,19 +837,32 @@ class TrackerGPS(Thread):
             # Write to log file
             self.writetolog()
 
+            if self.status is not None:
+                self.status.update(self)
+
+    def publish(self):
+        # Send the latest fix with the receiver status
+        fix = self.data.info.todict()
+        fix['mode'] = self.mode
+        fix['satellites'] = self.satellites
+        fix['satellites_used'] = self.satellites_used
+        fix['logging'] = self.islogging
+        self.publisher.publish(fix)
+
     def readsessionlog(self, name=None, filterrecords=False):
         # This is a utility function for use outside this class
         # Multiple GPSSummaries are created and returned. This doesn't
         # prime the GPS session with past entries. Use loadlog to do that
+        # The points of each session are in its log_items SessionTrack
 
         f = None
         sessions = []
         if name is None:
             name = self.todaylogname()
         try:
-            f = open(name, 'r')
+            f = openlog(name)
         except IOError:
-            print ("Error: Cannot open log file - {0}".format(name))
+            logtrace.error("Cannot open log file - {0}", name)
             return sessions # empty list
 
         s = f.readline()
@@ -318,7 +874,7 @@ class TrackerGPS(Thread):
         while s != "":
             try:
                 session.gps_serial_data = s
-                if not bfirstrecord and session.info['start_record']:
+                if not bfirstrecord and session.info.start_record:
                     sessionindex += 1
                     # Create new summary object
                     sessions.append(GPSSummary())
@@ -328,7 +884,7 @@ class TrackerGPS(Thread):
                 session.commit_data()
                 # Filtering can be enabled to remove records which appear as error points
                 # in the GPS results. This uses the same logic for distance calculations
-                if filterrecords and (lastinfo is None or lastinfo != session.longlatheld):
+                if filterrecords and lastinfo is not session.longlatheld:
                     # Only append longlatheld records which change
                     session.log_items.append(session.longlatheld)
                     lastinfo = session.longlatheld
@@ -344,27 +900,93 @@ class TrackerGPS(Thread):
         f.close()
         return sessions
         
+    def checkpointname(self, name = None):
+        if name is None:
+            name = self.todaylogname()
+        return checkpointpath(name)
+
+    def savecheckpoint(self, line):
+        # Save the summary and the position in the log it covers so that
+        # loading the log can start from here. line is the last record written.
+        # Called with the log lock held
+        offset = self.loghandle.tell()
+        # The end of the log covered is saved to detect a changed log
+        tail = line[-64:]
+        checkpoint = {'version':1,
+                      'name':self.loghandle.name,
+                      'offset':offset,
+                      'tail':tail,
+                      'summary':self.data.getstate()}
+        filename = self.checkpointname(self.loghandle.name)
+        try:
+            f = open(filename + '.tmp', 'w')
+            json.dump(checkpoint, f)
+            f.close()
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError):
+            logtrace.error("Cannot write the checkpoint file {0}", filename)
+
+    def loadcheckpoint(self, name, data):
+        # Restore the GPSSummary data from a checkpoint of the log name. Returns
+        # the offset of the log to read from or 0 if there's no valid checkpoint
+        try:
+            f = open(self.checkpointname(name), 'r')
+        except IOError:
+            return 0
+        try:
+            checkpoint = json.load(f)
+            if checkpoint['version'] != 1 or checkpoint['name'] != name:
+                return 0
+            offset = checkpoint['offset']
+            tail = checkpoint['tail'].encode('utf-8')
+            # Check the log still holds the record the checkpoint finished on
+            log = open(name, 'rb')
+            try:
+                log.seek(offset - len(tail))
+                if log.read(len(tail)) != tail:
+                    return 0
+            finally:
+                log.close()
+            data.setstate(checkpoint['summary'])
+            return offset
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            logtrace.warning("Ignoring checkpoint for log file {0}", name)
+            data.reset()
+            return 0
+        finally:
+            f.close()
+
     def loadlog(self, name = None, fn = None):
-        # Load today's log if no name specified
+        # Load today's log if no name specified. A checkpoint is used to
+        # skip records already summarised unless every record is wanted by fn.
+        # The log is replayed into a new summary which replaces data when
+        # done, as the reader may be changing data.info whilst this runs
 
         f = None
         entries = 0
         if name is None:
             name = self.todaylogname()
         try:
-            f = open(name, 'r')
+            f = openlog(name)
         except IOError:
-            print ("Warning: Cannot open log file, this may be due to a new log: {0}".format(name))
+            logtrace.warning("Cannot open log file, this may be due to a new log: {0}", name)
             return 0
 
+        data = GPSSummary()
+        if fn is None:
+            offset = self.loadcheckpoint(name, data)
+            if offset > 0:
+                f.seek(offset)
+                entries = data.records
+
         s = f.readline()
         while s != "":
             try:
-                self.data.gps_serial_data = s
-                self.data.commit_data()
+                data.gps_serial_data = s
+                data.commit_data()
                 if fn is not None:
                     # Call back with the info data loaded from file
-                    fn(self.data.info)
+                    fn(data.info)
                 entries += 1
             except ValueError:
                 pass
@@ -372,7 +994,12 @@ class TrackerGPS(Thread):
             s = f.readline()
 
         f.close()
-        self.data.previnfo = None
+        data.previnfo = None
+        self.__lock.acquire()
+        if self.data.info is not blank_fix:
+            data.info = self.data.info # Keep the newest fix from the reader
+        self.data = data
+        self.__lock.release()
         return entries
         
     @property
@@ -386,48 +1013,79 @@ class TrackerGPS(Thread):
         if self.islogging and time.time() - self.lastlogwrite > self.logperiod:
             if self.mode >= 2:
                 try:
-                    self.loghandle.write(self.data.gps_serial_data)
-                    self.loghandle.write('\n')
+                    info = self.data.info
+                    if info.start_record != self.newsession:
+                        info = info._replace(start_record=self.newsession)
+                        self.data.info = info
+                    line = info.tojson() + '\n'
+                    self.loghandle.write(line)
                     self.loghandle.flush()
                     self.lastlogwrite = time.time()
                     self.data.commit_data()
-                    self.data.info['start_record'] = False # record committed to log
+                    self.newsession = False # record committed to log
+                    self.uncheckpointed += 1
+                    if self.uncheckpointed >= self.checkpointperiod:
+                        self.savecheckpoint(line)
+                        self.uncheckpointed = 0
                 except:
-                    print ("Something went wrong trying to write to the log file")
+                    logtrace.error("Something went wrong trying to write to the log file")
                 
         self.__lock.release()
  
     def start(self):
-        # Increment reference
+        # Increment reference. The reader thread connects to gpsd and
+        # starts the watch for the first reference
         self.__references += 1
         if self.__references == 1:
-            # Start the GPS watching for first reference
-            self.gps.stream(gps.WATCH_ENABLE | gps.WATCH_NEWSTYLE)
+            self.duty.reset('tracking')
+            self.watching = True
+            self.wake()
 
         if self.__firstrun:
+            # Only made for a reader so summaries used just to read logs,
+            # e.g. by the web interface, don't hold file descriptors
+            (self.wakeup, self.__wakeupsend) = os.pipe()
             Thread.start(self) # Only start once
             self.__firstrun = False
             
     def stop(self):
-        # Stop the thread looping. Note that this may block if GPS
-        # is waiting for data
+        # Stop the watch when there are no references left. The connection
+        # is kept for the next start
         self.__references -= 1
 
-        if self.is_alive() and self.__references <= 0:
-            # Request a stop to the watch.
-            # This should cause the next() read to block
-            self.gps.stream(gps.WATCH_DISABLE)
+        if self.__references <= 0:
+            self.duty.reset('off')
+            self.watching = False
+            self.wake()
             self.data.previnfo = None # Clear previous entries
 
     def terminate(self):
         self.__quit = True
-
-        # Start the GPS to unblock the wait
-        self.gps.stream(gps.WATCH_ENABLE | gps.WATCH_NEWSTYLE)
+        self.wake()
         
         if self.is_alive():
             self.join()
+        self.disconnect()
+        if self.wakeup is not None:
+            os.close(self.wakeup)
+            os.close(self.__wakeupsend)
+            self.wakeup = None
+            self.__wakeupsend = None
         
+    def dutychanged(self, state, previous, spent, reason):
+        # Publish straight away as no reports arrive whilst resting
+        if self.status is not None:
+            self.status.update(self)
+
+    def setlowpower(self, lowpower):
+        # The Low power screen rests the GPS for longer
+        self.duty.lowpower = lowpower
+        self.wake()
+
+    @property
+    def resting(self):
+        return self.isrunning and self.duty.state == 'resting'
+
     @property
     def isrunning(self):
         if self.__references > 0: return True
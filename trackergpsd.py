@@ -0,0 +1,181 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A minimal gpsd client used in place of the gps module when gpsd_client is
+# 'raw' in config.py. It asks gpsd for JSON only and passes on just the TPV
+# and SKY reports as plain dicts. gpsd always writes the class first so other
+# reports are dropped by looking at the start of the line, without decoding.
+# The socket is non-blocking. next() raises socket.error with EAGAIN if a
+# whole report hasn't arrived, so wait for the socket to be readable first.
+# Otherwise stream(), waiting(), next() and linebuffer are as the gps module's
+# so TrackerGPS can use either client.
+
+import sys
+import json
+import time
+import errno
+import socket
+import select
+import argparse
+from threading import Thread
+from config import appconfig
+
+# Same values as the gps module
+WATCH_ENABLE = 0x000001
+WATCH_DISABLE = 0x000002
+WATCH_NEWSTYLE = 0x010000
+
+# Start of the lines wanted
+wanted = (b'{"class":"TPV"', b'{"class":"SKY"')
+
+class GPSDClient(object):
+    'Reads TPV and SKY reports from gpsd as dicts'
+
+    def __init__(self, host = None, port = None):
+        self.host = host if host is not None else appconfig['gpsd_host']
+        self.port = port if port is not None else appconfig['gpsd_port']
+        self.sock = socket.create_connection((self.host, self.port))
+        self.sock.setblocking(False)
+        self.linebuffer = b''
+        self.received = 0 # Lines read from gpsd
+        self.skipped = 0 # Lines which weren't TPV or SKY
+
+    def send(self, command):
+        self.sock.sendall(command.encode('ascii'))
+
+    def stream(self, flags = WATCH_ENABLE):
+        if flags & WATCH_DISABLE:
+            self.send('?WATCH={"enable":false};\n')
+        else:
+            self.send('?WATCH={"enable":true,"json":true};\n')
+
+    def waiting(self, timeout = 0):
+        # True if there's something to read
+        if len(self.linebuffer) > 0:
+            return True
+        (r, w, x) = select.select([self.sock], [], [], timeout)
+        return len(r) > 0
+
+    def next(self):
+        # Returns the next TPV or SKY report. Raises StopIteration when
+        # gpsd closes the connection, as the gps module does
+        while True:
+            eol = self.linebuffer.find(b'\n')
+            if eol == -1:
+                data = self.sock.recv(8192)
+                if len(data) == 0:
+                    raise StopIteration
+                self.linebuffer += data
+                continue
+            line = self.linebuffer[:eol + 1]
+            self.linebuffer = self.linebuffer[eol + 1:]
+            self.received += 1
+            if line.startswith(wanted):
+                try:
+                    return json.loads(line.decode('utf-8', 'replace'))
+                except ValueError:
+                    pass # Damaged report
+            self.skipped += 1
+
+    __next__ = next
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        self.sock.close()
+
+class Replay(Thread):
+    'Pretends to be gpsd, sending a recorded stream to each connection'
+
+    def __init__(self, lines):
+        Thread.__init__(self)
+        self.daemon = True
+        self.lines = lines
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        while True:
+            (conn, addr) = self.listener.accept()
+            try:
+                conn.recv(4096) # Wait for the WATCH as gpsd does
+                conn.sendall(b''.join(self.lines))
+                conn.shutdown(socket.SHUT_WR)
+            except socket.error:
+                pass
+            conn.close()
+
+def benchmark(client, port, repeat):
+    # Seconds for TrackerGPS to take in the replayed stream, best of repeat.
+    # Nothing is logged as no log is open
+    from trackergps import TrackerGPS
+    best = None
+    for i in range(repeat):
+        tracker = TrackerGPS()
+        start = time.time()
+        if client == 'raw':
+            source = GPSDClient('127.0.0.1', port)
+        else:
+            import gps
+            source = gps.gps('127.0.0.1', port)
+        source.stream(WATCH_ENABLE | WATCH_NEWSTYLE)
+        tracker.gps = source
+        reports = 0
+        try:
+            while source.waiting(5):
+                try:
+                    if client == 'raw':
+                        gpsdat = source.next()
+                    else:
+                        # The gps module's next() repeats the last report
+                        # after reading part of one so read as the tracker does
+                        gpsdat = tracker.nextreport()
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        continue # Part of a report
+                    raise
+                if gpsdat is not None:
+                    tracker.report(gpsdat)
+                    reports += 1
+        except StopIteration:
+            pass
+        source.close()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, reports)
+
+# Main
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time the gpsd clients reading a recorded gpsd stream, e.g. from gpspipe -w')
+    parser.add_argument('capture')
+    parser.add_argument('--client', choices=['gps', 'raw', 'both'], default='both')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    f = open(args.capture, 'rb')
+    lines = f.readlines()
+    f.close()
+    replay = Replay(lines)
+    replay.start()
+    clients = ['gps', 'raw'] if args.client == 'both' else [args.client]
+    for client in clients:
+        (secs, reports) = benchmark(client, replay.port, args.repeat)
+        print ("{0}: {1} lines, {2} reports in {3:.3f}s, {4:.1f}us per line".format(client, len(lines), reports, secs, secs * 1e6 / max(len(lines), 1)))
+    sys.exit(0)
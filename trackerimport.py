@@ -0,0 +1,352 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Import tracks from NMEA captures, GPX files and gpsd JSON dumps (gpspipe -w)
+# into the daily logs. Input files are read in parallel, each a line or point
+# at a time, and split into a part file per day. The parts for each day are
+# then merged in time order with any existing log for the day, also in
+# parallel. Memory use doesn't depend on the size of the inputs.
+# Input files may be gzipped and must be in time order. Fixes going back in
+# time are dropped.
+
+import os
+import sys
+import json
+import gzip
+import time
+import shutil
+import heapq
+import calendar
+import argparse
+import dateutil.parser
+from multiprocessing import Pool
+from xml.etree.ElementTree import iterparse
+from trackergps import GPSSummary
+from trackerlog import openlog, logpath, checkpointpath, compressed_ext, index_ext
+from config import appconfig
+
+knots = 0.514444 # m/s
+
+def _text(b):
+    # Decoded lines are str on both python 2 and 3
+    if isinstance(b, str):
+        return b
+    return b.decode('utf-8', 'replace')
+
+def parsetime(s):
+    # Seconds since the epoch of an ISO 8601 time. gpsd and most GPX files
+    # use YYYY-MM-DDTHH:MM:SS[.sss]Z which is parsed without dateutil
+    if len(s) >= 20 and s[-1] == 'Z' and s[10] == 'T':
+        secs = calendar.timegm(time.strptime(s[:19], '%Y-%m-%dT%H:%M:%S'))
+        if len(s) > 20:
+            secs += float('0' + s[19:-1])
+        return secs
+    t = dateutil.parser.parse(s)
+    if t.utcoffset() is not None:
+        return calendar.timegm(t.utctimetuple()) + t.microsecond / 1e6
+    return calendar.timegm(t.timetuple()) + t.microsecond / 1e6
+
+def nmeachecksum(sentence):
+    # True if the sentence has no checksum or a correct one
+    if '*' not in sentence:
+        return True
+    (body, check) = sentence[1:].split('*', 1)
+    total = 0
+    for c in body:
+        total ^= ord(c)
+    try:
+        return total == int(check[:2], 16)
+    except ValueError:
+        return False
+
+def nmeaangle(value, hemisphere):
+    # ddmm.mmmm or dddmm.mmmm to signed degrees
+    point = value.index('.') if '.' in value else len(value)
+    degrees = float(value[:point - 2]) + float(value[point - 2:]) / 60.0
+    if hemisphere in ('S', 'W'):
+        degrees = -degrees
+    return degrees
+
+def nmea(f):
+    # Fixes from RMC sentences, which have the date, with the altitude of
+    # the latest GGA sentence. Any talker, e.g. GP or GN, is accepted
+    altitude = None
+    for line in f:
+        line = _text(line).strip()
+        if not line.startswith('$') or not nmeachecksum(line):
+            continue
+        fields = line.split('*')[0].split(',')
+        kind = fields[0][3:]
+        try:
+            if kind == 'GGA':
+                if fields[6] != '0' and fields[9] != '':
+                    altitude = float(fields[9])
+            elif kind == 'RMC' and fields[2] == 'A':
+                (hms, date) = (fields[1], fields[9])
+                secs = calendar.timegm((2000 + int(date[4:6]), int(date[2:4]), int(date[0:2]),
+                                        int(hms[0:2]), int(hms[2:4]), int(hms[4:6]), 0, 0, 0))
+                fix = {'time': secs + float('0' + hms[6:]),
+                       'lat': nmeaangle(fields[3], fields[4]),
+                       'lon': nmeaangle(fields[5], fields[6]),
+                       'alt': altitude}
+                if fields[7] != '':
+                    fix['speed'] = float(fields[7]) * knots
+                yield fix
+        except (ValueError, IndexError):
+            pass # ignore malformed sentences
+
+def gpsdjson(f):
+    # Fixes from the TPV reports of gpspipe -w output
+    for line in f:
+        try:
+            report = json.loads(_text(line))
+            if report.get('class') != 'TPV' or report.get('mode', 0) < 2:
+                continue
+            t = report['time']
+            fix = {'time': parsetime(t) if not isinstance(t, (int, float)) else float(t),
+                   'lat': float(report['lat']),
+                   'lon': float(report['lon']),
+                   'alt': report.get('alt')}
+            for key in ['speed', 'climb', 'epx', 'epy', 'epv', 'eps', 'epc']:
+                if key in report:
+                    fix[key] = float(report[key])
+            yield fix
+        except (ValueError, KeyError, TypeError, AttributeError):
+            pass # ignore malformed and other reports
+
+def gpx(f):
+    # Fixes from the track points of a GPX file. Each track segment
+    # starts a new session. Points are discarded as they are read
+    segment = None
+    newsegment = False
+    for (event, elem) in iterparse(f, events=('start', 'end')):
+        tag = elem.tag.split('}')[-1]
+        if event == 'start':
+            if tag == 'trkseg':
+                segment = elem
+                newsegment = True
+            continue
+        if tag != 'trkpt':
+            continue
+        try:
+            fix = {'lat': float(elem.get('lat')), 'lon': float(elem.get('lon')), 'alt': None}
+            for child in elem:
+                childtag = child.tag.split('}')[-1]
+                if childtag == 'ele':
+                    fix['alt'] = float(child.text)
+                elif childtag == 'time':
+                    fix['time'] = parsetime(child.text.strip())
+            if 'time' in fix:
+                fix['segment'] = newsegment
+                newsegment = False
+                yield fix
+        except (ValueError, TypeError, AttributeError):
+            pass # ignore malformed points
+        elem.clear()
+        try:
+            segment.remove(elem)
+        except (ValueError, AttributeError):
+            pass # Not in a segment
+
+def sniff(f):
+    # Format of an input from its first character
+    start = _text(f.read(512)).lstrip()
+    f.seek(0)
+    if start.startswith('<'):
+        return gpx
+    if start.startswith('{'):
+        return gpsdjson
+    return nmea
+
+def record(fix, prev):
+    # Log record as written by the tracker. Speed and climb are worked out
+    # from the previous fix if the input doesn't have them
+    t = time.gmtime(fix['time'])
+    info = {'gpstime': '{0}.{1:03d}Z'.format(time.strftime('%Y-%m-%dT%H:%M:%S', t), int((fix['time'] % 1) * 1000)),
+            'timesec': (t.tm_hour * 3600) + (t.tm_min * 60) + t.tm_sec,
+            'latitude': fix['lat'],
+            'longitude': fix['lon'],
+            'altitude': fix['alt'] if fix['alt'] is not None else 0.0,
+            'error_latitude': fix.get('epy', 0.0),
+            'error_longitude': fix.get('epx', 0.0),
+            'error_altitude': fix.get('epv', 0.0),
+            'error_speed': fix.get('eps', 0.0),
+            'error_climb': fix.get('epc', 0.0),
+            'speed': fix.get('speed', 0.0),
+            'climb': fix.get('climb', 0.0),
+            'start_record': prev is None}
+    if prev is not None:
+        dt = fix['time'] - prev['time']
+        if 'speed' not in fix:
+            info['speed'] = GPSSummary.haversine(prev['lon'], prev['lat'], fix['lon'], fix['lat']) * 1000.0 / dt
+        if 'climb' not in fix and fix['alt'] is not None and prev['alt'] is not None:
+            info['climb'] = (fix['alt'] - prev['alt']) / dt
+    return info
+
+def day(secs):
+    # Logs are named by the tracker's local date
+    return time.strftime('%Y%m%d', time.localtime(secs))
+
+def splitinput(path, number, stagedir, period, gap):
+    # Read one input into part files named by day in stagedir. Only one
+    # fix every period seconds is kept, as when logging. A new session is
+    # started after gap seconds without a fix. Runs in a worker process so
+    # only takes and returns simple values. Returns (days, fixes written, fixes dropped)
+    opener = gzip.open if path.endswith('.gz') else open
+    try:
+        f = opener(path, 'rb')
+    except IOError as e:
+        print ("Cannot read {0}: {1}".format(path, e))
+        return ([], 0, 0)
+    days = []
+    written = 0
+    dropped = 0
+    part = None
+    partday = None
+    prev = None # Last fix written
+    try:
+        for fix in sniff(f)(f):
+            if prev is not None and fix['time'] <= prev['time']:
+                dropped += 1 # Going back in time
+                continue
+            newsession = prev is None or fix.get('segment', False) or fix['time'] - prev['time'] > gap
+            if not newsession and fix['time'] - prev['time'] < period:
+                continue
+            d = day(fix['time'])
+            if d != partday:
+                # Inputs are in time order so each day's part is written in one go
+                if part is not None:
+                    part.close()
+                part = open(os.path.join(stagedir, '{0}.{1}'.format(d, number)), 'a')
+                partday = d
+                if d not in days:
+                    days.append(d)
+            info = record(fix, None if newsession else prev)
+            part.write(json.dumps(info) + '\n')
+            written += 1
+            prev = fix
+    except Exception as e:
+        # Most likely a damaged XML or gzip file. Keep what was read
+        print ("Error reading {0}: {1}".format(path, e))
+    finally:
+        f.close()
+        if part is not None:
+            part.close()
+    return (days, written, dropped)
+
+def keyed(lines, source):
+    # (time, source, line number, record) of each log line for merging.
+    # Records without a readable time keep the time of the previous one
+    secs = 0
+    for (number, line) in enumerate(lines):
+        try:
+            info = json.loads(line)
+        except ValueError:
+            continue # ignore malformed log entries
+        try:
+            secs = parsetime(info['gpstime'])
+        except (ValueError, KeyError, TypeError):
+            pass
+        yield (secs, source, number, info)
+
+def mergeday(d, parts, logdir, prefix, gap):
+    # Merge the day's parts with any existing log into a new log in time
+    # order. Fixes already in the log are skipped so importing twice is
+    # harmless. Returns (day, records) or (day, None) if the log is skipped
+    name = logpath(logdir, prefix + d)
+    if d == time.strftime('%Y%m%d') and (os.path.exists(name) or os.path.exists(name + compressed_ext)):
+        print ("Not merging into today's log {0} as the tracker may be writing to it".format(name))
+        return (d, None)
+
+    files = []
+    try:
+        try:
+            files.append(openlog(name))
+        except IOError:
+            pass # No log for this day yet
+        for part in parts:
+            files.append(open(part, 'r'))
+
+        out = open(name + '.tmp', 'w')
+        records = 0
+        last = None
+        try:
+            for (secs, source, number, info) in heapq.merge(*[keyed(files[i], i) for i in range(len(files))]):
+                if last is not None and secs == last[0] and info['latitude'] == last[1] and info['longitude'] == last[2]:
+                    continue # Same fix, already in the log or imported twice
+                # A session starts where one started in its source or after a gap
+                info['start_record'] = last is None or info.get('start_record', False) or secs - last[0] > gap
+                out.write(json.dumps(info) + '\n')
+                records += 1
+                last = (secs, info['latitude'], info['longitude'])
+        finally:
+            out.close()
+    finally:
+        for f in files:
+            f.close()
+
+    os.rename(name + '.tmp', name)
+    # The uncompressed log replaces any archived one, which the tracker will
+    # compress again later. A checkpoint no longer matches the log
+    for old in [name + compressed_ext, name + compressed_ext + index_ext, checkpointpath(name)]:
+        if os.path.exists(old):
+            os.remove(old)
+    return (d, records)
+
+def importfiles(paths, logdir = None, prefix = None, period = 20, gap = 600, processes = None):
+    # Import the input files into the daily logs. Returns a dict of day to
+    # number of records in that day's log
+    logdir = logdir if logdir is not None else appconfig['logdir']
+    prefix = prefix if prefix is not None else appconfig['prefix']
+    stagedir = os.path.join(logdir, '.import{0}'.format(os.getpid()))
+    os.makedirs(stagedir)
+    pool = Pool(processes)
+    try:
+        results = [pool.apply_async(splitinput, (paths[i], i, stagedir, period, gap)) for i in range(len(paths))]
+        days = {}
+        for i in range(len(paths)):
+            (inputdays, written, dropped) = results[i].get()
+            print ("{0}: {1} fixes over {2} days{3}".format(paths[i], written, len(inputdays),
+                                                           ', {0} out of order dropped'.format(dropped) if dropped > 0 else ''))
+            for d in inputdays:
+                days.setdefault(d, []).append(os.path.join(stagedir, '{0}.{1}'.format(d, i)))
+
+        results = [pool.apply_async(mergeday, (d, days[d], logdir, prefix, gap)) for d in sorted(days.keys())]
+        merged = {}
+        for r in results:
+            (d, records) = r.get()
+            if records is not None:
+                merged[d] = records
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(stagedir, ignore_errors=True)
+    return merged
+
+# Main
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import NMEA, GPX and gpsd JSON files into the tracker logs')
+    parser.add_argument('inputs', nargs='+', help='files to import, optionally gzipped')
+    parser.add_argument('--logdir', default=appconfig['logdir'])
+    parser.add_argument('--period', type=float, default=20, help='seconds between fixes kept, as when logging')
+    parser.add_argument('--gap', type=float, default=600, help='seconds without a fix which start a new session')
+    parser.add_argument('--processes', type=int, default=None, help='default is one per CPU')
+    args = parser.parse_args()
+
+    merged = importfiles(args.inputs, args.logdir, None, args.period, args.gap, args.processes)
+    for d in sorted(merged.keys()):
+        print ("{0}{1}: {2} records".format(appconfig['prefix'], d, merged[d]))
+    if len(merged) == 0:
+        sys.exit(1)
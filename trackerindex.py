@@ -0,0 +1,371 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The web interface serves logs from one or more trackers. Each tracker's logs
+# are in their own directory, e.g. synced from the tracker with rsync. The
+# summary of each log is kept in an index file in the log directory and only
+# logs which have changed since they were indexed are read again. Logs needing
+# indexing on any device are read in parallel by a pool of worker processes.
+# The log names are held in order so a page of logs, or the logs between two
+# dates, are found without sorting or listing the directory.
+
+import os
+import json
+import time
+import datetime
+from bisect import bisect_left, bisect_right, insort
+from threading import Thread, Lock, RLock
+from multiprocessing import Pool
+from trackergps import GPSSummary, update_bounds, merge_bounds
+from trackerlog import openlog, lognames, resolvelog, logpath
+from config import appconfig, webconfig
+
+index_version = 2
+
+# Totals of a group of summaries
+total_keys = ['km', 'mile', 'secs', 'records', 'sessions']
+groups = ['day', 'week', 'month']
+
+def summarise(logfile):
+    # Summary of a log as a dict, or None if it can't be read. This runs in
+    # a worker process so only takes and returns simple values
+    summary = GPSSummary()
+    bounds = None
+    try:
+        f = openlog(logfile)
+    except IOError:
+        return None
+    for line in f:
+        try:
+            summary.gps_serial_data = line
+            summary.commit_data()
+            bounds = update_bounds(bounds, summary.info.latitude, summary.info.longitude)
+        except (ValueError, KeyError):
+            pass # ignore malformed log entries
+    f.close()
+    return {'km': summary.km,
+            'mile': summary.mile,
+            'secs': summary.secs,
+            'records': summary.records,
+            'sessions': summary.sessions_recorded,
+            'min_height': summary.min_height,
+            'max_height': summary.max_height,
+            'bounds': bounds}
+
+def newtotal():
+    total = {'logs': 0, 'min_height': None, 'max_height': None, 'bounds': None}
+    for key in total_keys:
+        total[key] = 0
+    return total
+
+def combine(total, summary):
+    # Add a log summary, or another total, to a total
+    total['logs'] += summary.get('logs', 1)
+    for key in total_keys:
+        total[key] += summary[key]
+    if summary['records'] > 0 and summary['min_height'] is not None:
+        if total['min_height'] is None or summary['min_height'] < total['min_height']:
+            total['min_height'] = summary['min_height']
+        if total['max_height'] is None or summary['max_height'] > total['max_height']:
+            total['max_height'] = summary['max_height']
+    total['bounds'] = merge_bounds(total['bounds'], summary['bounds'])
+    return total
+
+def period(date, group):
+    # Name of the day, ISO week or month holding a YYYYMMDD date.
+    # Raises ValueError if date isn't a date
+    day = datetime.date(int(date[0:4]), int(date[4:6]), int(date[6:8]))
+    if group == 'week':
+        (year, week, weekday) = day.isocalendar()
+        return '{0}-W{1:02d}'.format(year, week)
+    if group == 'month':
+        return day.strftime('%Y-%m')
+    return day.strftime('%Y-%m-%d')
+
+def logstamp(logfile):
+    # Identifies the content of a log. Changes when the log is written or archived
+    st = os.stat(resolvelog(logfile))
+    return [int(st.st_mtime), st.st_size]
+
+class LogIndex(object):
+    'Summaries of the logs in one directory, saved alongside the logs'
+
+    def __init__(self, logdir, prefix = None):
+        self.logdir = logdir
+        self.prefix = prefix if prefix is not None else appconfig['prefix']
+        self.path = os.path.join(logdir, '.' + self.prefix + '.index')
+        self.entries = {} # Log name to summary, with the stamp it was made from
+        self.names = [] # Names of the entries in order
+        self.loaded = False
+        self.changed = False # Entries differ from the saved index
+        self.listed = None # Modified time of logdir when the logs were last listed
+        self.listtime = 0
+        self.rescan = webconfig['index_rescan_secs']
+        # Held whilst entries and names are changed or read. They're changed
+        # by Fleet.update, which may be on another thread to the readers
+        self.lock = RLock()
+
+    def load(self):
+        try:
+            f = open(self.path, 'r')
+            try:
+                index = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return # Missing or damaged so rebuilt on update
+        if index.get('version') == index_version:
+            names = sorted(index['logs'].keys())
+            self.lock.acquire()
+            self.entries = index['logs']
+            self.names = names
+            self.lock.release()
+
+    def save(self):
+        # Write a new file then rename so readers never see part of an index
+        try:
+            f = open(self.path + '.tmp', 'w')
+            self.lock.acquire()
+            try:
+                json.dump({'version': index_version, 'logs': self.entries}, f)
+            finally:
+                self.lock.release()
+                f.close()
+            os.rename(self.path + '.tmp', self.path)
+            self.changed = False
+        except (IOError, OSError):
+            pass # Read only log directory, the index is rebuilt in memory next time
+
+    def open(self):
+        # Load the saved index on first use
+        self.lock.acquire()
+        try:
+            if not self.loaded:
+                self.load()
+                self.loaded = True
+        finally:
+            self.lock.release()
+
+    def listing(self):
+        # Names of the logs which may have changed. Logs are added, removed
+        # and archived by renaming, which changes the directory, so whilst it
+        # is unchanged only the newest log, which is still being written, is
+        # checked. Everything is listed every rescan seconds to catch logs
+        # changed in place. Entries for removed logs are dropped
+        now = time.time()
+        try:
+            mtime = os.stat(self.logdir).st_mtime
+        except OSError:
+            mtime = None # Device hasn't synced yet
+        if mtime is not None and mtime == self.listed and now - self.listtime < self.rescan:
+            return self.names[-1:]
+        try:
+            names = lognames(self.logdir, self.prefix)
+        except OSError:
+            names = []
+        # A change within a second of listing may not alter the modified
+        # time so it isn't trusted until it is older
+        self.listed = mtime if mtime is not None and now - mtime > 1 else None
+        self.listtime = now
+        present = set(names)
+        for name in [n for n in self.names if n not in present]:
+            self.remove(name)
+        return names
+
+    def stale(self):
+        # Names and stamps of logs which are new or have changed since they
+        # were indexed
+        self.open()
+        names = self.listing()
+        stale = []
+        for name in names:
+            try:
+                stamp = logstamp(logpath(self.logdir, name))
+            except OSError:
+                continue # Removed whilst listing
+            entry = self.entries.get(name)
+            if entry is None or entry['stamp'] != stamp:
+                stale.append((name, stamp))
+        return stale
+
+    def add(self, name, stamp, summary):
+        if summary is None:
+            self.remove(name) # Unreadable
+            return
+        summary['stamp'] = stamp
+        self.lock.acquire()
+        self.changed = True
+        if name not in self.entries:
+            insort(self.names, name)
+        self.entries[name] = summary
+        self.lock.release()
+
+    def remove(self, name):
+        self.lock.acquire()
+        if name in self.entries:
+            del self.entries[name]
+            del self.names[bisect_left(self.names, name)]
+            self.changed = True
+        self.lock.release()
+
+    def refresh(self, name):
+        # Index one log straight away, e.g. when it is closed. The saved index
+        # is read first as another process may have updated it
+        self.load()
+        self.loaded = True
+        path = logpath(self.logdir, name)
+        try:
+            self.add(name, logstamp(path), summarise(path))
+        except OSError:
+            return # Removed
+        self.save()
+
+    def date(self, name):
+        # YYYYMMDD part of a log name
+        return name[len(self.prefix):]
+
+    def summaries(self, start = None, end = None):
+        # (name, summary) of logs in name order, optionally limited to
+        # logs dated between start and end inclusive as YYYYMMDD strings
+        self.lock.acquire()
+        try:
+            first = 0 if start is None else bisect_left(self.names, self.prefix + start)
+            last = len(self.names) if end is None else bisect_right(self.names, self.prefix + end)
+            return [(name, self.entries[name]) for name in self.names[first:last]]
+        finally:
+            self.lock.release()
+
+    def page(self, cursor = None, limit = 50):
+        # Up to limit (name, summary) of logs, newest first, from the log
+        # before the one named cursor or from the newest log. Returns the
+        # logs and the cursor for the next page, None after the oldest log.
+        # As the cursor is a name, new logs don't move the later pages
+        self.lock.acquire()
+        try:
+            end = len(self.names) if cursor is None else bisect_left(self.names, cursor)
+            first = max(end - limit, 0)
+            names = self.names[first:end]
+            names.reverse()
+            logs = [(name, self.entries[name]) for name in names]
+        finally:
+            self.lock.release()
+        return (logs, names[-1] if first > 0 else None)
+
+    def indexed(self):
+        # Names of the indexed logs in order
+        self.lock.acquire()
+        names = list(self.names)
+        self.lock.release()
+        return names
+
+    def totals(self, start = None, end = None):
+        totals = newtotal()
+        for (name, summary) in self.summaries(start, end):
+            combine(totals, summary)
+        return totals
+
+class Fleet(object):
+    'Log indexes of every device served by the web interface'
+
+    def __init__(self, devices = None):
+        # devices maps a device name to its log directory. With no devices
+        # configured this tracker's logs are served as a single device
+        if devices is None:
+            devices = webconfig['devices']
+        if len(devices) == 0:
+            devices = {'tracker': appconfig['logdir']}
+        self.indexes = {}
+        for name in devices:
+            self.indexes[name] = LogIndex(devices[name])
+        self.workers = webconfig['index_workers']
+        self.pool = None
+        self.updater = None # Thread updating the indexes in the background
+        self.__lock = Lock()
+
+    @property
+    def names(self):
+        return sorted(self.indexes.keys())
+
+    def index(self, device):
+        # Raises KeyError for unknown devices
+        return self.indexes[device]
+
+    def local(self):
+        # Name of the device holding this tracker's logs, or None
+        for name in self.indexes:
+            if os.path.abspath(self.indexes[name].logdir) == os.path.abspath(appconfig['logdir']):
+                return name
+        return None
+
+    def update(self, devices = None):
+        # Bring the indexes of devices, default all, up to date. Stale logs
+        # from every device are summarised together by the worker pool.
+        # Returns the indexes updated
+        if devices is None:
+            devices = self.names
+        indexes = [self.indexes[d] for d in devices]
+        self.__lock.acquire()
+        try:
+            work = []
+            for index in indexes:
+                for (name, stamp) in index.stale():
+                    work.append((index, name, stamp))
+            if len(work) == 1:
+                # Usually just today's log so save starting workers
+                (index, name, stamp) = work[0]
+                summaries = [summarise(logpath(index.logdir, name))]
+            elif len(work) > 1:
+                if self.pool is None:
+                    self.pool = Pool(self.workers)
+                summaries = self.pool.map(summarise, [logpath(w[0].logdir, w[1]) for w in work])
+            for i in range(len(work)):
+                (index, name, stamp) = work[i]
+                index.add(name, stamp, summaries[i])
+            for index in indexes:
+                if index.changed:
+                    index.save()
+        finally:
+            self.__lock.release()
+        return indexes
+
+    def updatelater(self, devices = None):
+        # Update the indexes on another thread so the caller never reads a log
+        if self.updater is None or not self.updater.is_alive():
+            self.updater = Thread(target=self.update, args=(devices,))
+            self.updater.daemon = True
+            self.updater.start()
+
+    def stats(self, devices, start = None, end = None, group = 'day'):
+        # Totals of each day, week or month between start and end, as
+        # YYYYMMDD, for the devices using only the indexes. Returns a sorted
+        # list of (period, totals)
+        periods = {}
+        for device in devices:
+            index = self.indexes[device]
+            index.open()
+            for (name, summary) in index.summaries(start, end):
+                try:
+                    key = period(index.date(name), group)
+                except ValueError:
+                    continue # Not a daily log
+                if key not in periods:
+                    periods[key] = newtotal()
+                combine(periods[key], summary)
+        return sorted(periods.items())
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,138 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Live fixes are sent from the tracker to the web interface as datagrams on a
+# Unix socket. Sending never blocks: if the web interface isn't running or
+# isn't keeping up then fixes are dropped rather than holding up the tracker.
+
+import os
+import json
+import socket
+from collections import deque
+from threading import Thread, Condition
+from config import appconfig
+
+class LivePublisher(object):
+    'Sends each new fix to the web interface'
+
+    def __init__(self, path = None):
+        self.path = path if path is not None else appconfig['live_socket']
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sent = 0
+        self.dropped = 0
+
+    def publish(self, record):
+        try:
+            self.sock.sendto(json.dumps(record).encode('utf-8'), self.path)
+            self.sent += 1
+        except socket.error:
+            # No listener or its buffer is full
+            self.dropped += 1
+
+    def close(self):
+        self.sock.close()
+
+class LiveClient(object):
+    'Bounded buffer of fixes waiting to be sent to one client'
+
+    def __init__(self, feed, size):
+        self.feed = feed
+        self.pending = deque(maxlen=size) # Oldest fixes are dropped when full
+
+    def get(self, timeout):
+        # Returns all pending fixes, waiting up to timeout seconds for one.
+        # An empty list is returned if nothing arrived
+        self.feed.cond.acquire()
+        try:
+            if len(self.pending) == 0:
+                self.feed.cond.wait(timeout)
+            msgs = list(self.pending)
+            self.pending.clear()
+        finally:
+            self.feed.cond.release()
+        return msgs
+
+class LiveFeed(Thread):
+    'Receives fixes from the tracker and fans them out to any number of clients'
+
+    def __init__(self, path = None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.path = path if path is not None else appconfig['live_socket']
+        self.buffer = appconfig['live_buffer']
+        self.maxclients = appconfig['live_clients']
+        self.cond = Condition()
+        self.clients = []
+        self.last = None # Most recent fix for new clients
+        self.received = 0
+        self.__quit = False
+        self.__firstrun = True
+
+        # Remove a socket left behind by a previous run
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.settimeout(1) # Check for quit each second
+
+    def run(self):
+        while not self.__quit:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            msg = data.decode('utf-8')
+            self.cond.acquire()
+            self.received += 1
+            self.last = msg
+            for client in self.clients:
+                client.pending.append(msg)
+            self.cond.notify_all()
+            self.cond.release()
+
+    def start(self):
+        if self.__firstrun:
+            Thread.start(self) # Only start once
+            self.__firstrun = False
+
+    def subscribe(self):
+        # Returns a new client or None if there are too many
+        self.cond.acquire()
+        try:
+            if len(self.clients) >= self.maxclients:
+                return None
+            client = LiveClient(self, self.buffer)
+            if self.last is not None:
+                client.pending.append(self.last)
+            self.clients.append(client)
+        finally:
+            self.cond.release()
+        return client
+
+    def unsubscribe(self, client):
+        self.cond.acquire()
+        if client in self.clients:
+            self.clients.remove(client)
+        self.cond.release()
+
+    def terminate(self):
+        self.__quit = True
+        if self.is_alive():
+            self.join()
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
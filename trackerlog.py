@@ -0,0 +1,298 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Closed daily logs are compressed into a series of gzip members each holding
+# a whole number of lines. Each member can be decompressed on its own so a
+# small index of member offsets allows seeking without reading the whole file.
+# The concatenated members are still a valid gzip file for command line tools.
+
+import os
+import time
+import zlib
+import json
+from threading import Thread, Event
+from config import appconfig
+
+compressed_ext = '.gz'
+index_ext = '.idx'
+
+def logpath(logdir, name):
+    return '{0}/{1}'.format(logdir, name)
+
+def checkpointpath(name):
+    # Hidden file next to the log so it isn't listed as a log
+    (head, tail) = os.path.split(name)
+    return os.path.join(head, '.' + tail + '.ckpt')
+
+def lognames(logdir, prefix):
+    # Sorted logical names of all logs in logdir. A compressed log is listed
+    # without its extension so links and names are the same whatever the storage
+    names = set()
+    for fname in os.listdir(logdir):
+        if fname[0:len(prefix)] != prefix:
+            continue
+        if fname.endswith(compressed_ext):
+            names.add(fname[:-len(compressed_ext)])
+        elif not fname.endswith(index_ext) and not fname.endswith('.tmp'):
+            names.add(fname)
+    return sorted(names)
+
+def resolvelog(name):
+    # Returns the file holding the log name. An uncompressed log takes priority
+    # as it may still be open or part way through archiving
+    if os.path.exists(name):
+        return name
+    if not name.endswith(compressed_ext) and os.path.exists(name + compressed_ext):
+        return name + compressed_ext
+    return name
+
+def openlog(name):
+    # Open a log by logical name or file name, compressed or not.
+    # Raises IOError if the log doesn't exist
+    path = resolvelog(name)
+    if path.endswith(compressed_ext):
+        return CompressedLog(path)
+    return PlainLog(path)
+
+def _text(b):
+    # Decoded lines are str on both python 2 and 3
+    if isinstance(b, str):
+        return b
+    return b.decode('utf-8', 'replace')
+
+class PlainLog(object):
+    'Uncompressed log file'
+
+    def __init__(self, name):
+        self.name = name
+        self.f = open(name, 'r')
+
+    def readline(self):
+        return self.f.readline()
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def seek(self, offset):
+        self.f.seek(offset)
+
+    def tell(self):
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class CompressedLog(object):
+    'Reads a block compressed log, decompressing a block at a time'
+
+    chunk = 16384
+
+    def __init__(self, name):
+        self.name = name
+        self.f = open(name, 'rb')
+        self.blocks = self.readindex(name)
+        self.__reset(0, 0)
+
+    @staticmethod
+    def readindex(name):
+        # List of (compressed offset, uncompressed offset) for each block.
+        # A missing index only loses seeking, the log can still be read
+        try:
+            f = open(name + index_ext, 'r')
+        except IOError:
+            return [(0, 0)]
+        try:
+            index = json.load(f)
+            return [tuple(b) for b in index['blocks']]
+        except (ValueError, KeyError, TypeError):
+            return [(0, 0)]
+        finally:
+            f.close()
+
+    def __reset(self, coffset, uoffset):
+        self.f.seek(coffset)
+        self.decomp = zlib.decompressobj(16 + zlib.MAX_WBITS) # gzip member
+        self.buffer = b''
+        self.bufpos = 0 # Read position within the buffer
+        self.position = uoffset # Uncompressed offset of the read position
+        self.eof = False
+
+    def __fill(self):
+        # Decompress more data into the buffer. Returns False at the end of the file
+        while not self.eof:
+            data = self.f.read(self.chunk)
+            if not data:
+                self.buffer = self.buffer[self.bufpos:] + self.decomp.flush()
+                self.bufpos = 0
+                self.eof = True
+                break
+            out = self.decomp.decompress(data)
+            while self.decomp.unused_data:
+                # End of a gzip member, carry on with the next
+                rest = self.decomp.unused_data
+                self.decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                out += self.decomp.decompress(rest)
+            if out:
+                self.buffer = self.buffer[self.bufpos:] + out
+                self.bufpos = 0
+                return True
+        return False
+
+    def readline(self):
+        while True:
+            i = self.buffer.find(b'\n', self.bufpos)
+            if i >= 0:
+                line = self.buffer[self.bufpos:i+1]
+                self.bufpos = i + 1
+                self.position += len(line)
+                return _text(line)
+            if not self.__fill():
+                line = self.buffer[self.bufpos:]
+                self.bufpos = len(self.buffer)
+                self.position += len(line)
+                return _text(line)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def seek(self, offset):
+        # Seek to an uncompressed offset, only decompressing the block holding it
+        block = self.blocks[0]
+        for b in self.blocks:
+            if b[1] > offset:
+                break
+            block = b
+        self.__reset(block[0], block[1])
+        skip = offset - block[1]
+        while skip > 0:
+            if self.bufpos == len(self.buffer) and not self.__fill():
+                break
+            n = min(skip, len(self.buffer) - self.bufpos)
+            self.bufpos += n
+            self.position += n
+            skip -= n
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def compresslog(name, blocksize = None, level = 6):
+    # Compress the log name into name.gz with an index and remove the original.
+    # The compressed log only appears once complete so readers never see a partial file
+    if blocksize is None:
+        blocksize = appconfig['archive_block_size']
+    blocks = []
+    target = name + compressed_ext
+    src = open(name, 'rb')
+    dst = open(target + '.tmp', 'wb')
+    try:
+        uoffset = 0
+        while True:
+            # Blocks end on a line so a seek never lands part way through a record
+            data = src.read(blocksize)
+            if not data:
+                break
+            data += src.readline()
+            blocks.append((dst.tell(), uoffset))
+            comp = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            dst.write(comp.compress(data))
+            dst.write(comp.flush())
+            uoffset += len(data)
+    finally:
+        src.close()
+        dst.close()
+
+    f = open(target + index_ext, 'w')
+    json.dump({'version':1, 'size':uoffset, 'blocks':blocks}, f)
+    f.close()
+    # Keep the time the log was last written so anything cached from it stays fresh
+    mtime = os.path.getmtime(name)
+    os.utime(target + '.tmp', (mtime, mtime))
+    os.rename(target + '.tmp', target)
+    os.remove(name)
+    # A checkpoint is only needed whilst the tracker may still load the log
+    if os.path.exists(checkpointpath(name)):
+        os.remove(checkpointpath(name))
+    return target
+
+class LogArchiver(Thread):
+    'Background thread compressing daily logs which are no longer written to'
+
+    def __init__(self, logdir = None, prefix = None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logdir = logdir if logdir is not None else appconfig['logdir']
+        self.prefix = prefix if prefix is not None else appconfig['prefix']
+        self.age = appconfig['archive_age'] # seconds since last write
+        self.period = 3600 # seconds between checks
+        self.onarchive = None # Called with the name of each log compressed
+        self.__wake = Event()
+        self.__quit = False
+
+    def closedlogs(self):
+        # Past days' logs which haven't been written for a while. The age check
+        # covers a session still logging into yesterday's file after midnight
+        today = '{0}{1}'.format(self.prefix, time.strftime('%Y%m%d'))
+        now = time.time()
+        logs = []
+        for fname in lognames(self.logdir, self.prefix):
+            path = logpath(self.logdir, fname)
+            if fname == today or not os.path.exists(path):
+                continue
+            try:
+                if now - os.path.getmtime(path) > self.age:
+                    logs.append(path)
+            except OSError:
+                pass
+        return logs
+
+    def archive(self):
+        archived = 0
+        for path in self.closedlogs():
+            if self.__quit:
+                break
+            try:
+                compresslog(path)
+                archived += 1
+            except (IOError, OSError):
+                print ("Cannot archive log file {0}".format(path))
+                continue
+            if self.onarchive is not None:
+                self.onarchive(os.path.basename(path))
+        return archived
+
+    def run(self):
+        while not self.__quit:
+            self.archive()
+            self.__wake.wait(self.period)
+
+    def terminate(self):
+        self.__quit = True
+        self.__wake.set()
+        if self.is_alive():
+            self.join()
@@ -0,0 +1,43 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Only the standard library can be used here as this is imported before
+# anything else to time the imports of the application
+
+import sys
+import time
+
+class StartupTimeline(object):
+    'Records the time taken by each step of starting the tracker'
+
+    def __init__(self):
+        self.enabled = '--profile-startup' in sys.argv
+        self.start = time.time()
+        self.marks = []
+
+    def mark(self, label):
+        # Note that label has just finished
+        if self.enabled:
+            self.marks.append((time.time(), label))
+
+    def report(self):
+        if not self.enabled:
+            return
+        print ("Startup timeline")
+        last = self.start
+        for (t, label) in self.marks:
+            print ("{0:8.1f}ms {1:+8.1f}ms {2}".format((t - self.start) * 1000, (t - last) * 1000, label))
+            last = t
+
+timeline = StartupTimeline()
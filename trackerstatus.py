@@ -0,0 +1,188 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The tracker's live state is published as a fixed layout record in a memory
+# mapped file. Other processes map the same file and read it directly.
+# A sequence counter protects the record: the writer makes it odd before
+# changing the record and even afterwards. A reader copies the record and
+# only accepts the copy if the counter was even and unchanged throughout.
+
+import os
+import mmap
+import time
+import struct
+from threading import Lock
+from config import appconfig
+
+magic = b'GPST'
+version = 2
+
+# magic, version, record size, sequence
+header = struct.Struct('<4sHHQ')
+# Field names and formats of the record following the header
+fields = [('updated', 'd'), # time.time() of the last update
+          ('mode', 'i'),
+          ('satellites', 'i'),
+          ('satellites_used', 'i'),
+          ('logging', 'i'),
+          ('battery', 'i'),
+          ('timesec', 'i'),
+          ('latitude', 'd'),
+          ('longitude', 'd'),
+          ('altitude', 'd'),
+          ('speed', 'd'),
+          ('climb', 'd'),
+          ('error_latitude', 'd'),
+          ('error_longitude', 'd'),
+          ('error_altitude', 'd'),
+          ('km', 'd'),
+          ('mile', 'd'),
+          ('secs', 'd'),
+          ('records', 'i'),
+          ('sessions', 'i'),
+          ('min_height', 'd'),
+          ('max_height', 'd'),
+          ('duty', 'i'), # Index of the GPS duty cycle state in DutyCycle.states
+          ('rested_secs', 'd'), # Time the GPS has rested whilst stationary
+          ('gpstime', '32s')]
+record = struct.Struct('<' + ''.join([f[1] for f in fields]))
+size = header.size + record.size
+
+class StatusWriter(object):
+    'Publishes the tracker state to a memory mapped file'
+
+    def __init__(self, path = None):
+        self.path = path if path is not None else appconfig['status_file']
+        self.values = dict([(f[0], b'' if f[1].endswith('s') else 0) for f in fields])
+        self.values['battery'] = -1 # Unknown
+        self.seq = 0
+        self.__lock = Lock() # GPS thread and main loop both update
+
+        # Reuse the file from a previous run so readers which already
+        # have it mapped carry on seeing updates
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        (m, v, length, seq) = header.unpack_from(self.map, 0)
+        if m == magic and v == version and length == record.size:
+            self.seq = seq + (seq & 1) # Carry on counting from the last run
+        header.pack_into(self.map, 0, magic, version, record.size, self.seq)
+
+    def write(self, **values):
+        self.__lock.acquire()
+        try:
+            self.values.update(values)
+            self.values['updated'] = time.time()
+            packed = record.pack(*[self.values[f[0]] for f in fields])
+            self.seq += 1 # Odd whilst writing
+            header.pack_into(self.map, 0, magic, version, record.size, self.seq)
+            self.map[header.size:size] = packed
+            self.seq += 1
+            header.pack_into(self.map, 0, magic, version, record.size, self.seq)
+        finally:
+            self.__lock.release()
+
+    def update(self, gps):
+        # Take the state from a TrackerGPS object
+        info = gps.data.info
+        summary = gps.data
+        self.write(mode = gps.mode,
+                   satellites = gps.satellites,
+                   satellites_used = gps.satellites_used,
+                   logging = 1 if gps.islogging else 0,
+                   timesec = int(info.timesec),
+                   latitude = info.latitude,
+                   longitude = info.longitude,
+                   altitude = info.altitude,
+                   speed = info.speed,
+                   climb = info.climb,
+                   error_latitude = info.error_latitude,
+                   error_longitude = info.error_longitude,
+                   error_altitude = info.error_altitude,
+                   km = summary.km,
+                   mile = summary.mile,
+                   secs = summary.secs,
+                   records = summary.records,
+                   sessions = summary.sessions_recorded,
+                   min_height = summary.min_height,
+                   max_height = summary.max_height,
+                   duty = gps.duty.states.index(gps.duty.state),
+                   rested_secs = gps.duty.seconds('resting'),
+                   gpstime = info.gpstime.encode('ascii', 'replace')[:32])
+
+    def close(self):
+        self.map.close()
+
+class StatusReader(object):
+    'Reads consistent snapshots of the tracker state'
+
+    def __init__(self, path = None):
+        self.path = path if path is not None else appconfig['status_file']
+        self.map = None
+
+    def open(self):
+        # Map the file. False if the tracker hasn't published yet
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return False
+        try:
+            self.map = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            return False # File is too short
+        finally:
+            f.close()
+        return True
+
+    def read(self, retries = 100):
+        # Returns the state as a dict, or None if there is no valid record
+        if self.map is None and not self.open():
+            return None
+        for i in range(retries):
+            (m, v, length, seq) = header.unpack_from(self.map, 0)
+            if m != magic or v != version or length != record.size:
+                # Not a status record that can be read
+                return None
+            if seq & 1:
+                continue # Write in progress
+            data = self.map[header.size:size]
+            if header.unpack_from(self.map, 0)[3] != seq:
+                continue # Changed whilst copying
+            if seq == 0:
+                return None # Nothing published yet
+            values = record.unpack(data)
+            state = dict([(fields[n][0], values[n]) for n in range(len(fields))])
+            state['gpstime'] = state['gpstime'].rstrip(b'\0').decode('ascii')
+            state['seq'] = seq
+            return state
+        return None
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+# Main
+
+if __name__ == '__main__':
+    reader = StatusReader()
+    state = reader.read()
+    if state is None:
+        print ("No tracker status available")
+    else:
+        for f in fields:
+            print ("{0}: {1}".format(f[0], state[f[0]]))
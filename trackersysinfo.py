@@ -0,0 +1,183 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+from threading import Thread, Lock, Event
+from config import appconfig
+
+class SystemInfo(Thread):
+    'Background collector of system information read from /proc and /sys'
+
+    def __init__(self, refresh = None):
+        Thread.__init__(self)
+        self.daemon = True # Never hold up the application exiting
+        if refresh is None:
+            refresh = appconfig['sysinfo_refresh']
+        self.refresh = refresh # seconds between collections
+        self.path = appconfig['logdir'] # File system to report free space
+        self.__lock = Lock()
+        self.__quit = False
+        self.__firstrun = True
+        self.__wake = Event()
+        self.__active = Event()
+        self.__snapshot = self.empty()
+
+    @staticmethod
+    def empty():
+        return {'ip':[],
+                'load':(0.0, 0.0, 0.0),
+                'mem_total_kb':0,
+                'mem_free_kb':0,
+                'disk_total_kb':0,
+                'disk_free_kb':0,
+                'cpu_temp':None,
+                'uptime':0.0,
+                'time':0}
+
+    @staticmethod
+    def read_file(name):
+        # Read a small kernel file in one go. Returns an empty
+        # string if the file cannot be read on this system
+        try:
+            f = open(name, 'r')
+        except IOError:
+            return ''
+        try:
+            return f.read()
+        except IOError:
+            return ''
+        finally:
+            f.close()
+
+    @classmethod
+    def ip_addresses(cls):
+        # Equivalent of 'hostname -I' without a fork. Local IPv4 addresses are
+        # listed in the routing trie as a '|-- addr' line followed by '/32 host LOCAL'
+        addresses = []
+        last = None
+        for line in cls.read_file('/proc/net/fib_trie').splitlines():
+            line = line.strip()
+            if line.startswith('|--'):
+                last = line[3:].strip()
+            elif line.startswith('/32 host LOCAL') and last is not None:
+                if not last.startswith('127.') and last not in addresses:
+                    addresses.append(last)
+                last = None
+        return addresses
+
+    @classmethod
+    def load_average(cls):
+        try:
+            fields = cls.read_file('/proc/loadavg').split()
+            return (float(fields[0]), float(fields[1]), float(fields[2]))
+        except (IndexError, ValueError):
+            return (0.0, 0.0, 0.0)
+
+    @classmethod
+    def memory(cls):
+        # Returns (total, available) in kB
+        meminfo = {}
+        for line in cls.read_file('/proc/meminfo').splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                try:
+                    meminfo[fields[0].rstrip(':')] = int(fields[1])
+                except ValueError:
+                    pass
+        total = meminfo.get('MemTotal', 0)
+        if 'MemAvailable' in meminfo:
+            available = meminfo['MemAvailable']
+        else:
+            # Older kernels don't report available memory
+            available = meminfo.get('MemFree', 0) + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+        return (total, available)
+
+    def disk(self):
+        # Returns (total, free) in kB for the log file system
+        try:
+            st = os.statvfs(self.path)
+        except OSError:
+            return (0, 0)
+        return ((st.f_blocks * st.f_frsize) // 1024, (st.f_bavail * st.f_frsize) // 1024)
+
+    @classmethod
+    def cpu_temperature(cls):
+        # Reported in millidegrees C. None if no thermal zone exists
+        try:
+            return int(cls.read_file('/sys/class/thermal/thermal_zone0/temp').strip()) / 1000.0
+        except ValueError:
+            return None
+
+    @classmethod
+    def uptime(cls):
+        try:
+            return float(cls.read_file('/proc/uptime').split()[0])
+        except (IndexError, ValueError):
+            return 0.0
+
+    def collect(self):
+        # Build a complete new snapshot and swap it in. Readers
+        # only ever see a finished snapshot
+        info = self.empty()
+        info['ip'] = self.ip_addresses()
+        info['load'] = self.load_average()
+        (info['mem_total_kb'], info['mem_free_kb']) = self.memory()
+        (info['disk_total_kb'], info['disk_free_kb']) = self.disk()
+        info['cpu_temp'] = self.cpu_temperature()
+        info['uptime'] = self.uptime()
+        info['time'] = time.time()
+        self.__lock.acquire()
+        self.__snapshot = info
+        self.__lock.release()
+
+    @property
+    def snapshot(self):
+        self.__lock.acquire()
+        info = self.__snapshot
+        self.__lock.release()
+        return info
+
+    def run(self):
+        # The first snapshot is collected by start
+        while not self.__quit:
+            self.__wake.wait(self.refresh)
+            # Sleep whilst paused
+            self.__active.wait()
+            self.__wake.clear()
+            if self.__quit:
+                break
+            self.collect()
+
+    def start(self):
+        # Resume collection, collecting immediately. The first time this
+        # collects before returning so there's something to show straight away
+        self.__active.set()
+        if self.__firstrun:
+            self.collect()
+            Thread.start(self) # Only start once
+            self.__firstrun = False
+        else:
+            self.__wake.set()
+
+    def stop(self):
+        # Pause collection. The last snapshot is kept
+        self.__active.clear()
+
+    def terminate(self):
+        self.__quit = True
+        self.__active.set()
+        self.__wake.set()
+        if self.is_alive():
+            self.join()
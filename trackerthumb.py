@@ -0,0 +1,142 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+from math import cos, radians
+from threading import Lock
+from multiprocessing import Pool
+from PIL import Image
+from PIL import ImageDraw
+from trackerlog import openlog, resolvelog, logpath
+from config import appconfig
+
+# Same line colours as the route map
+session_colours = ['#FF0000', '#00FF00', '#0000FF', '#FFFF00', '#FF8040', '#8000FF', '#FF0080', '#804000']
+
+def readtracks(logfile):
+    # List of sessions, each a list of (lon, lat) points
+    tracks = []
+    f = openlog(logfile)
+    for line in f:
+        try:
+            info = json.loads(line)
+            if info.get('start_record', False) or len(tracks) == 0:
+                tracks.append([])
+            tracks[-1].append((info['longitude'], info['latitude']))
+        except (ValueError, KeyError):
+            pass # ignore malformed log entries
+    f.close()
+    return [t for t in tracks if len(t) > 0]
+
+def render_thumbnail(logfile, thumbfile, size):
+    # Draw the thumbnail of a log. This runs in a worker process so only
+    # takes and returns simple values. Any failure, e.g. a damaged
+    # compressed log, returns None so the cache always hears the thumbnail
+    # has finished and can ask for it again
+    try:
+        return draw_thumbnail(logfile, thumbfile, size)
+    except Exception:
+        return None
+
+def draw_thumbnail(logfile, thumbfile, size):
+    # Draw each session's track scaled to fit the thumbnail
+    try:
+        tracks = readtracks(logfile)
+    except IOError:
+        return None
+    image = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    border = 4
+    if len(tracks) > 0:
+        lons = [p[0] for t in tracks for p in t]
+        lats = [p[1] for t in tracks for p in t]
+        # Equirectangular projection is good enough at this scale
+        xscale = cos(radians((min(lats) + max(lats)) / 2.0))
+        width = max((max(lons) - min(lons)) * xscale, 1e-9)
+        height = max(max(lats) - min(lats), 1e-9)
+        scale = min((size[0] - 2*border) / width, (size[1] - 2*border) / height)
+        # Centre the route in the thumbnail
+        xoff = (size[0] - width * scale) / 2.0
+        yoff = (size[1] - height * scale) / 2.0
+        minlon = min(lons)
+        maxlat = max(lats)
+        for i, t in enumerate(tracks):
+            points = [(xoff + (p[0] - minlon) * xscale * scale, yoff + (maxlat - p[1]) * scale) for p in t]
+            colour = session_colours[i % len(session_colours)]
+            if len(points) == 1:
+                draw.point(points, fill=colour)
+            else:
+                draw.line(points, fill=colour, width=2)
+
+    # Only replace the cached thumbnail once it is complete
+    try:
+        image.save(thumbfile + '.tmp', 'PNG')
+        os.rename(thumbfile + '.tmp', thumbfile)
+    except (IOError, OSError):
+        return None
+    return thumbfile
+
+class ThumbnailCache(object):
+    'Renders and caches route thumbnails of logs using a pool of worker processes'
+
+    def __init__(self, logdir = None, thumbdir = None):
+        self.logdir = logdir if logdir is not None else appconfig['logdir']
+        self.thumbdir = thumbdir if thumbdir is not None else appconfig['thumbdir']
+        self.size = appconfig['thumb_size']
+        self.workers = appconfig['thumb_workers']
+        self.pool = None
+        self.pending = set()
+        self.__lock = Lock()
+
+    def path(self, name):
+        return logpath(self.thumbdir, name + '.png')
+
+    def isfresh(self, name):
+        # A thumbnail is fresh if it was drawn after the log last changed
+        try:
+            return os.path.getmtime(self.path(name)) >= os.path.getmtime(resolvelog(logpath(self.logdir, name)))
+        except OSError:
+            return False
+
+    def request(self, name):
+        # Queue a thumbnail for rendering if it is missing or stale.
+        # Returns True if the cached thumbnail can be used now
+        if self.isfresh(name):
+            return True
+        self.__lock.acquire()
+        try:
+            if name not in self.pending:
+                if self.pool is None:
+                    if not os.path.isdir(self.thumbdir):
+                        os.makedirs(self.thumbdir)
+                    self.pool = Pool(self.workers)
+                self.pending.add(name)
+                self.pool.apply_async(render_thumbnail,
+                                      (logpath(self.logdir, name), self.path(name), self.size),
+                                      callback=lambda f: self.finished(name))
+        finally:
+            self.__lock.release()
+        return os.path.exists(self.path(name)) # Stale thumbnail is better than none
+
+    def finished(self, name):
+        self.__lock.acquire()
+        self.pending.discard(name)
+        self.__lock.release()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
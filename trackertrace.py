@@ -0,0 +1,159 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Trace of what the tracker has been doing, held in memory in place of
+# printing. Each part of the tracker records events in its own category:
+#   tracker.info("Running GPS")
+# An event is kept if its level is at or above the level of its category,
+# set by trace_levels in config.py, otherwise it is dropped straight away.
+# Messages are only formatted with their arguments when the trace is dumped.
+# For code run for every log record test the category before working out
+# the arguments:
+#   if distance.debugging: distance.debug("Time delta is {0}sec", timedelta)
+# The newest trace_size events are kept. They're printed on trace_signal
+# and the web server's own trace is at /api/trace
+
+import signal
+import time
+from collections import deque
+from threading import RLock
+from config import appconfig
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+levels = {'debug': DEBUG,
+          'info': INFO,
+          'warning': WARNING,
+          'error': ERROR,
+          'off': OFF}
+level_names = dict([(v, k) for (k, v) in levels.items()])
+
+class TraceCategory(object):
+    'Records events of one part of the tracker at or above its level'
+
+    def __init__(self, trace, name, level):
+        self.trace = trace
+        self.name = name
+        self.setlevel(level)
+
+    def setlevel(self, level):
+        # level is a number or a name from levels
+        self.level = levels.get(level, level)
+        self.debugging = self.level <= DEBUG # Tested before costly debug events
+
+    def event(self, level, message, *args):
+        if level >= self.level:
+            self.trace.record(self.name, level, message, args)
+
+    def debug(self, message, *args):
+        if self.debugging:
+            self.trace.record(self.name, DEBUG, message, args)
+
+    def info(self, message, *args):
+        if self.level <= INFO:
+            self.trace.record(self.name, INFO, message, args)
+
+    def warning(self, message, *args):
+        if self.level <= WARNING:
+            self.trace.record(self.name, WARNING, message, args)
+
+    def error(self, message, *args):
+        if self.level <= ERROR:
+            self.trace.record(self.name, ERROR, message, args)
+
+class Trace(object):
+    'Ring buffer of the most recent trace events'
+
+    def __init__(self, size = None):
+        if size is None:
+            size = appconfig['trace_size']
+        self.events = deque(maxlen = size)
+        # Reentrant as the signal handler dumps on the main thread, which
+        # may be part way through recording
+        self.lock = RLock()
+        self.categories = {}
+        self.recorded = 0 # Events recorded, including those no longer held
+        self.printlevel = levels[appconfig['trace_print']] # Also printed as recorded
+
+    def category(self, name):
+        # The category called name, created with its level from config.py
+        self.lock.acquire()
+        try:
+            if name not in self.categories:
+                level = appconfig['trace_levels'].get(name, appconfig['trace_level'])
+                self.categories[name] = TraceCategory(self, name, level)
+            return self.categories[name]
+        finally:
+            self.lock.release()
+
+    def record(self, category, level, message, args):
+        event = (time.time(), category, level, message, args)
+        self.lock.acquire()
+        self.events.append(event)
+        self.recorded += 1
+        self.lock.release()
+        if level >= self.printlevel:
+            print (self.format(event))
+
+    @staticmethod
+    def message(event):
+        (t, category, level, message, args) = event
+        if len(args) == 0:
+            return message
+        try:
+            return message.format(*args)
+        except (IndexError, KeyError, ValueError):
+            return '{0} {1}'.format(message, args) # Don't lose a badly formed event
+
+    @staticmethod
+    def format(event):
+        t = event[0]
+        return '{0}.{1:03d} {2:7} {3:8} {4}'.format(time.strftime('%H:%M:%S', time.localtime(t)),
+                                                     int((t % 1) * 1000),
+                                                     level_names.get(event[2], event[2]),
+                                                     event[1],
+                                                     Trace.message(event))
+
+    def snapshot(self, category = None, level = DEBUG):
+        # Held events, oldest first. Only those of category, if given, and
+        # at or above level
+        self.lock.acquire()
+        events = list(self.events)
+        self.lock.release()
+        return [e for e in events if e[2] >= level and (category is None or e[1] == category)]
+
+    def todicts(self, category = None, level = DEBUG):
+        # Held events which can be serialised with json
+        return [{'time': e[0],
+                 'category': e[1],
+                 'level': level_names.get(e[2], e[2]),
+                 'message': self.message(e)} for e in self.snapshot(category, level)]
+
+    def dump(self, category = None, level = DEBUG):
+        print ("Trace of {0} events, last {1} held".format(self.recorded, len(self.events)))
+        for event in self.snapshot(category, level):
+            print (self.format(event))
+
+    def dumponsignal(self, signum = None):
+        # Dump the trace on signum, trace_signal in config.py by default.
+        # Must be called from the main thread
+        if signum is None:
+            signum = getattr(signal, appconfig['trace_signal'])
+        signal.signal(signum, lambda signum, frame: self.dump())
+
+trace = Trace()
@@ -0,0 +1,226 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Today's log is appended to whilst the tracker is logging. Rather than reading
+# the whole log for every web request the web process keeps a model of its
+# sessions and only reads the bytes appended since the last read. inotify is
+# used to wake the reader when the log changes, falling back to polling if
+# inotify isn't available.
+
+import os
+import time
+import copy
+import select
+import struct
+import ctypes
+import ctypes.util
+from threading import Thread, Lock
+from trackergps import GPSSummary, SessionTrack, update_bounds
+from trackerlog import logpath
+from config import appconfig
+
+# inotify event masks from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+inotify_event = struct.Struct('iIII') # wd, mask, cookie, name length
+
+class LogModel(object):
+    'Sessions of a log built incrementally as the log grows'
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.offset = 0 # Bytes of the log read so far
+        self.partial = b'' # Incomplete last line
+        self.sessions = []
+        # Filtered records for each session, see TrackerGPS.readsessionlog
+        self.filtered = []
+        self.bounds = None
+        self.filteredbounds = None
+        self.lastinfo = None
+        self.firstrecord = True
+
+    def update(self):
+        # Read anything appended to the log. Returns True if the model changed
+        try:
+            size = os.path.getsize(self.name)
+        except OSError:
+            size = 0 # Log removed, e.g. compressed by the archiver
+        if size < self.offset:
+            # Log was truncated or replaced so start again
+            self.reset()
+        if size == self.offset:
+            return False
+
+        f = open(self.name, 'rb')
+        try:
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        finally:
+            f.close()
+        self.offset += len(data)
+
+        lines = (self.partial + data).split(b'\n')
+        # The last line isn't complete until a newline is written
+        self.partial = lines.pop()
+        for line in lines:
+            self.addline(line.decode('utf-8', 'replace'))
+        return True
+
+    def addline(self, s):
+        # Same as one pass of TrackerGPS.readsessionlog, keeping both
+        # the filtered and unfiltered records
+        if len(self.sessions) == 0:
+            self.sessions.append(GPSSummary())
+            self.filtered.append(SessionTrack())
+        session = self.sessions[-1]
+        try:
+            session.gps_serial_data = s
+            if not self.firstrecord and session.info.start_record:
+                session = GPSSummary()
+                self.sessions.append(session)
+                self.filtered.append(SessionTrack())
+                session.gps_serial_data = s
+
+            session.commit_data()
+            info = session.info
+            session.log_items.append(info)
+            self.bounds = update_bounds(self.bounds, info.latitude, info.longitude)
+            held = session.longlatheld
+            if self.lastinfo is not held:
+                self.filtered[-1].append(held)
+                self.filteredbounds = update_bounds(self.filteredbounds, held.latitude, held.longitude)
+                self.lastinfo = held
+            self.firstrecord = False
+        except ValueError:
+            pass # ignore malformed log entries
+
+    def snapshot(self, filterrecords = False):
+        # Copies of the sessions which are safe to use whilst the model
+        # carries on growing. Only the tracks of points are copied
+        sessions = []
+        for i in range(len(self.sessions)):
+            s = copy.copy(self.sessions[i])
+            if filterrecords:
+                s.log_items = self.filtered[i].copy()
+            else:
+                s.log_items = s.log_items.copy()
+            sessions.append(s)
+        if filterrecords:
+            bounds = copy.copy(self.filteredbounds)
+        else:
+            bounds = copy.copy(self.bounds)
+        return (sessions, bounds)
+
+class LogWatcher(Thread):
+    'Keeps a model of today\'s log up to date in the background'
+
+    def __init__(self, logdir = None, prefix = None):
+        Thread.__init__(self)
+        self.daemon = True
+        self.logdir = logdir if logdir is not None else appconfig['logdir']
+        self.prefix = prefix if prefix is not None else appconfig['prefix']
+        self.poll = 5 # seconds between checks without inotify
+        self.model = None
+        self.__lock = Lock()
+        self.__quit = False
+        self.__firstrun = True
+        self.fd = self.inotify()
+
+    def inotify(self):
+        # Returns an inotify file descriptor watching the log directory or None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        wd = libc.inotify_add_watch(fd, self.logdir.encode('utf-8'), IN_MODIFY | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO)
+        if wd < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def todayname(self):
+        return '{0}{1}'.format(self.prefix, time.strftime('%Y%m%d'))
+
+    def events(self, timeout):
+        # Names of files changed in the log directory. Without inotify
+        # every call returns today's log after the poll time
+        if self.fd is None:
+            time.sleep(self.poll)
+            return [self.todayname()]
+        (r, w, x) = select.select([self.fd], [], [], timeout)
+        if len(r) == 0:
+            return []
+        data = os.read(self.fd, 4096)
+        names = []
+        i = 0
+        while i + inotify_event.size <= len(data):
+            (wd, mask, cookie, length) = inotify_event.unpack_from(data, i)
+            i += inotify_event.size
+            names.append(data[i:i+length].rstrip(b'\0').decode('utf-8', 'replace'))
+            i += length
+        return names
+
+    def refresh(self):
+        # Swap to a new model at midnight then read anything new
+        self.__lock.acquire()
+        try:
+            name = logpath(self.logdir, self.todayname())
+            if self.model is None or self.model.name != name:
+                self.model = LogModel(name)
+            self.model.update()
+        finally:
+            self.__lock.release()
+
+    def run(self):
+        while not self.__quit:
+            self.refresh()
+            # Wait for the log to change. The timeout catches midnight
+            while not self.__quit:
+                names = self.events(60)
+                if len(names) == 0 or self.todayname() in names:
+                    break
+
+    def start(self):
+        if self.__firstrun:
+            self.refresh() # Build the model before the first request
+            Thread.start(self) # Only start once
+            self.__firstrun = False
+
+    def istoday(self, name):
+        return name == self.todayname()
+
+    def sessions(self, filterrecords = False):
+        # Returns (sessions, bounds) for today's log
+        self.__lock.acquire()
+        try:
+            return self.model.snapshot(filterrecords)
+        finally:
+            self.__lock.release()
+
+    def terminate(self):
+        self.__quit = True
+        if self.is_alive():
+            self.join()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
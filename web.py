@@ -12,77 +12,142 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from flask import Flask, render_template, request, url_for
+from flask import Flask, Response, jsonify, request, url_for, send_file, abort, stream_with_context
 import trackergps as gps
-from summarydisplay import hms
+from trackergps import update_bounds, merge_bounds
 import os
-from config import webconfig
+import time
+from trackerlog import openlog, resolvelog
+from trackerexport import formats
+from trackerthumb import ThumbnailCache
+from trackerlive import LiveFeed
+from trackerstatus import StatusReader
+from trackerwatch import LogWatcher
+from trackerindex import Fleet, newtotal, combine, groups
+from trackertrace import trace, levels
+from threading import Lock
+from summarydisplay import hms
+from config import webconfig, appconfig
 
 app = Flask(__name__)
+fleet = Fleet() # Logs of every tracker served
+thumbnails = {} # ThumbnailCache for each device
+livefeed = None # Started by the first live client
+startlock = Lock() # Background threads are started on first use
+status = StatusReader()
+logwatcher = None # Started by the first route request
 
-def update_bounds(bounds, data):
-    if bounds is None:
-        bounds = {}
-        bounds['minlat'] = data['latitude']
-        bounds['maxlat'] = data['latitude']
-        bounds['minlon'] = data['longitude']
-        bounds['maxlon'] = data['longitude']
-        return bounds
-    
-    bounds['minlat'] = min(bounds['minlat'], data['latitude'])
-    bounds['minlon'] = min(bounds['minlon'], data['longitude'])
-    bounds['maxlon'] = max(bounds['maxlon'], data['longitude'])
-    bounds['maxlat'] = max(bounds['maxlat'], data['latitude'])
+def stream_template(name, **context):
+    # Render a template as it is sent rather than building the whole page in memory
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(name).stream(context)
+    stream.enable_buffering(20) # Send in batches rather than per template item
+    return Response(stream_with_context(stream))
+
+def getindex(device):
+    # Returns (device, LogIndex). Paths without a device are for this tracker's logs
+    if device is None:
+        device = fleet.local()
+    try:
+        return (device, fleet.index(device))
+    except KeyError:
+        abort(404)
+
+def getthumbnails(device):
+    startlock.acquire()
+    try:
+        if device not in thumbnails:
+            if device == fleet.local():
+                thumbdir = appconfig['thumbdir']
+            else:
+                thumbdir = os.path.join(appconfig['thumbdir'], device)
+            thumbnails[device] = ThumbnailCache(fleet.index(device).logdir, thumbdir)
+    finally:
+        startlock.release()
+    return thumbnails[device]
+
+def totaltimes(summary):
+    # Rounded distances and time as shown on the index pages
+    (h,m,s) = hms(summary['secs'])
+    return {'miles': round(summary['mile'],2),
+            'kms': round(summary['km'],2),
+            'hour': format(h, '02d'),
+            'min': format(m, '02d'),
+            'sec': format(s, '02d')}
 
-    return bounds
+def isopen(index, name):
+    # Today's log is still being written so isn't worth drawing
+    return name == '{0}{1}'.format(index.prefix, time.strftime('%Y%m%d'))
+
+def logsummaries(device, logs):
+    # Items shown in the log grid for (name, summary) of a device's logs
+    cache = getthumbnails(device)
+    index = fleet.index(device)
+    for (fname, summary) in logs:
+        # Thumbnails are drawn in the background. Missing ones appear on a later visit
+        thumb = None
+        if isopen(index, fname):
+            if os.path.exists(cache.path(fname)):
+                thumb = url_for('showthumb', device=device, name=fname)
+        elif cache.request(fname):
+            thumb = url_for('showthumb', device=device, name=fname)
+
+        item = {'name': fname,
+                'hlink': url_for('showroute', device=device, name=fname, filter='y'),
+                'thumb': thumb}
+        item.update(totaltimes(summary))
+        yield item
+
+def devicesummaries():
+    # Totals of each device's logs for the combined index page
+    fleet.update()
+    for device in fleet.names:
+        index = fleet.index(device)
+        names = index.indexed()
+        item = {'name': device,
+                'hlink': url_for('showdevice', device=device),
+                'logs': len(names),
+                'last': names[-1] if len(names) > 0 else ''}
+        item.update(totaltimes(index.totals()))
+        yield item
 
 @app.route('/')
 def showmenu():
-    gpslogfiles = []
-    glog = gps.TrackerGPS()
-    files = os.listdir(glog.logdir)
-    files.sort()
-    for fname in files:
-        if fname[0:len(glog.logfilename)] == glog.logfilename:
-            # Match found
-            # Attempt to read
-            try:
-                f = open(glog.logdir + '/' + fname, "r")
-                sline = f.readline()
-                while sline != "":
-                    try:
-                        glog.data.gps_serial_data = sline
-                        glog.data.commit_data() # Build summary information
-                    except ValueError:
-                        pass
-
-                    sline = f.readline()
-
-                # Take the summary info and add to web template data
-                kms = round(glog.data.km,2)
-                miles = round(glog.data.mile,2)
-                (h,m,s) = hms(glog.data.secs)
-
-                gpslogfiles.append({'name': fname,
-                                    'hlink': url_for('showroute', name=fname, filter='y'),
-                                    'miles': miles,
-                                    'kms': kms,
-                                    'hour': format(h, '02d'),
-                                    'min': format(m, '02d'),
-                                    'sec': format(s, '02d')})
-                glog.data.reset() # Reset summary data
-                
-            except IOError:
-                # Ignore IO errors on files
-                pass
-
-    return render_template('main.html', data=gpslogfiles)
-
-@app.route('/route/<name>')
-def showroute(name):
+    if len(fleet.names) == 1:
+        return showdevice(fleet.names[0])
+    return stream_template('fleet.html', data=devicesummaries())
+
+@app.route('/device/<device>/')
+def showdevice(device):
+    # The newest page of logs. The page fetches older ones from /api/logs
+    # as it is scrolled. Only logs which have changed since they were last
+    # indexed are read
+    (device, index) = getindex(device)
+    fleet.update([device])
+    (logs, cursor) = index.page(None, webconfig['page_logs'])
+    return stream_template('main.html', device=device, data=logsummaries(device, logs), cursor=cursor,
+                           more=url_for('showlogs', device=device))
+
+@app.route('/thumb/<name>', defaults={'device': None})
+@app.route('/device/<device>/thumb/<name>')
+def showthumb(device, name):
+    (device, index) = getindex(device)
+    if name not in index.indexed():
+        abort(404)
+    cache = getthumbnails(device)
+    if not os.path.exists(cache.path(name)):
+        if not isopen(index, name):
+            cache.request(name)
+        abort(404)
+    return send_file(cache.path(name), mimetype='image/png')
+
+@app.route('/route/<name>', defaults={'device': None})
+@app.route('/device/<device>/route/<name>')
+def showroute(device, name):
     bounds = None
     glog = gps.TrackerGPS()
     filt = False
+    (device, index) = getindex(device)
 
     try:
         if request.args.get('filter','') == 'y':
@@ -90,22 +155,28 @@ def showroute(name):
     except KeyError:
         pass
 
-    openfile = glog.logdir + '/' + name
-    sessions = glog.readsessionlog(openfile, filterrecords=filt)
+    if device == fleet.local() and getlogwatcher().istoday(name):
+        # Today's log is kept up to date in the background
+        (sessions, bounds) = getlogwatcher().sessions(filterrecords=filt)
+    else:
+        openfile = index.logdir + '/' + name
+        sessions = glog.readsessionlog(openfile, filterrecords=filt)
+
+        # Each session's bounds are found as the log is read
+        for s in sessions:
+            bounds = merge_bounds(bounds, s.log_items.bounds)
 
-    # Calculate bounds
     for s in sessions:
         s.mile = round(s.mile, 2)
         s.km = round(s.km,2)
         (s.h, s.m, s.s) = hms(s.secs)
-        for log in s.log_items:
-            bounds = update_bounds(bounds, log)
 
-    return render_template('route.html', data=sessions, bounds=bounds, key = webconfig['googlekey'])
+    return stream_template('route.html', data=sessions, bounds=bounds, key = webconfig['googlekey'])
     
-@app.route('/log/')
-@app.route('/log/<name>')
-def showlog(name = None):
+@app.route('/log/', defaults={'device': None})
+@app.route('/log/<name>', defaults={'device': None})
+@app.route('/device/<device>/log/<name>')
+def showlog(device, name = None):
     gpspoints = []
     f = None
     bounds = None
@@ -114,11 +185,12 @@ def showlog(name = None):
         # Directory listing
         return showmenu() # OR should this redirect?
 
+    (device, index) = getindex(device)
     glog = gps.TrackerGPS()
 
     # To Do: Check that this file name is safe
     try:
-        f = open(glog.logdir + '/' + name, "r")
+        f = openlog(index.logdir + '/' + name)
     except IOError:
         return "Error"
     s = f.readline()
@@ -126,7 +198,7 @@ def showlog(name = None):
         try:                
             glog.data.gps_serial_data = s
             glog.data.commit_data()
-            bounds = update_bounds(bounds, glog.data.info)
+            bounds = update_bounds(bounds, glog.data.info.latitude, glog.data.info.longitude)
             gpspoints.append(glog.data.info)
             
         except ValueError:
@@ -137,8 +209,167 @@ def showlog(name = None):
 
     f.close()
 
-    return render_template('map.html', data=gpspoints, bounds=bounds, key = webconfig['googlekey'])
+    return stream_template('map.html', data=gpspoints, bounds=bounds, key = webconfig['googlekey'])
+
+@app.route('/export/<name>.<fmt>', defaults={'device': None, 'session': None})
+@app.route('/export/<name>/<int:session>.<fmt>', defaults={'device': None})
+@app.route('/device/<device>/export/<name>.<fmt>', defaults={'session': None})
+@app.route('/device/<device>/export/<name>/<int:session>.<fmt>')
+def exportlog(device, name, fmt, session):
+    # Download a log, or one session from it, as gpx, kml or geojson.
+    # The file is sent as the log is read
+    (device, index) = getindex(device)
+    if fmt not in formats:
+        abort(404)
+    logfile = index.logdir + '/' + name
+    if not os.path.exists(resolvelog(logfile)):
+        abort(404)
+    if session is None:
+        filename = '{0}.{1}'.format(name, fmt)
+    else:
+        filename = '{0}-{1}.{2}'.format(name, session, fmt)
+    (generator, mimetype) = formats[fmt]
+    return Response(generator(logfile, name, session), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename={0}'.format(filename)})
+
+def getlogwatcher():
+    global logwatcher
+    startlock.acquire()
+    try:
+        if logwatcher is None:
+            logwatcher = LogWatcher()
+            logwatcher.start()
+    finally:
+        startlock.release()
+    return logwatcher
+
+def getlivefeed():
+    global livefeed
+    startlock.acquire()
+    try:
+        if livefeed is None:
+            livefeed = LiveFeed()
+            livefeed.start()
+    finally:
+        startlock.release()
+    return livefeed
+
+@app.route('/live')
+def showlive():
+    # Server-Sent Events stream of fixes from the tracker
+    try:
+        client = getlivefeed().subscribe()
+    except (IOError, OSError):
+        return "Error: Live feed unavailable", 503
+    if client is None:
+        return "Error: Too many live clients", 503
+
+    def events():
+        try:
+            yield 'retry: 5000\n\n' # Browser reconnect time in ms
+            while True:
+                msgs = client.get(15)
+                if len(msgs) == 0:
+                    yield ': keepalive\n\n' # Detects closed connections
+                for m in msgs:
+                    yield 'data: {0}\n\n'.format(m)
+        finally:
+            livefeed.unsubscribe(client)
+
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/api/status')
+def showstatus():
+    # Current tracker state read from shared memory
+    state = status.read()
+    if state is None:
+        return jsonify(available=False)
+    state['available'] = True
+    return jsonify(**state)
+
+@app.route('/api/devices')
+def showdevices():
+    # Totals for each device, and all of them together, from the indexes.
+    # Limit to devices with device=name and dates with from=YYYYMMDD&to=YYYYMMDD
+    devices = request.args.getlist('device')
+    if len(devices) == 0:
+        devices = fleet.names
+    for device in devices:
+        getindex(device) # Unknown devices are not found
+    start = request.args.get('from')
+    end = request.args.get('to')
+    result = {}
+    total = newtotal()
+    fleet.update(devices)
+    for device in devices:
+        totals = fleet.index(device).totals(start, end)
+        combine(total, totals)
+        result[device] = totals
+    return jsonify(devices=result, total=total)
+
+@app.route('/api/trace')
+def showtrace():
+    # Recent trace events of the web server, oldest first. Limit to one
+    # category with category=name and to level=debug|info|warning|error or above
+    level = request.args.get('level', 'debug')
+    if level not in levels:
+        abort(400)
+    events = trace.todicts(request.args.get('category'), levels[level])
+    return jsonify(recorded=trace.recorded, events=events)
+
+@app.route('/api/logs')
+def showlogs():
+    # A device's logs, newest first, limit=n at a time up to four pages.
+    # Pass the cursor returned for the next page. It is null after the
+    # oldest log
+    (device, index) = getindex(request.args.get('device'))
+    try:
+        limit = int(request.args.get('limit', webconfig['page_logs']))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return "Error: limit must be a positive number", 400
+    limit = min(limit, webconfig['page_logs'] * 4) # Each log may need reading
+    fleet.update([device])
+    (logs, cursor) = index.page(request.args.get('cursor'), limit)
+    return jsonify(device=device, logs=list(logsummaries(device, logs)), cursor=cursor)
+
+def isdate(arg):
+    return arg is None or (len(arg) == 8 and arg.isdigit())
+
+@app.route('/api/stats')
+def showstats():
+    # Totals for each day, week or month between from=YYYYMMDD and
+    # to=YYYYMMDD with group=day|week|month. This only reads the indexes
+    # so answers straight away. Logs changed since they were indexed are
+    # read in the background and included in later answers
+    devices = request.args.getlist('device')
+    if len(devices) == 0:
+        devices = fleet.names
+    for device in devices:
+        getindex(device) # Unknown devices are not found
+    start = request.args.get('from')
+    end = request.args.get('to')
+    group = request.args.get('group', 'day')
+    if not isdate(start) or not isdate(end):
+        return "Error: Dates must be YYYYMMDD", 400
+    if group not in groups:
+        return "Error: group must be one of {0}".format(', '.join(groups)), 400
+
+    periods = fleet.stats(devices, start, end, group)
+    fleet.updatelater(devices)
+    total = newtotal()
+    result = []
+    for (name, totals) in periods:
+        combine(total, totals)
+        totals['period'] = name
+        result.append(totals)
+    return jsonify(group=group, periods=result, total=total)
 
+@app.route('/map/live')
+def showlivemap():
+    return stream_template('live.html', key = webconfig['googlekey'])
 
 if __name__ == '__main__':
-    app.run(webconfig['interface'], webconfig['port'], debug=True)
+    # Development server. Use webserver.py when running on the tracker
+    app.run(webconfig['interface'], webconfig['port'], debug=webconfig['debug'])
@@ -0,0 +1,177 @@
+# Copyright 2017 Aidan Holmes
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+# http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Production entry point for the web interface. The Flask development server
+# handles one request at a time and runs in debug mode. This serves the same
+# app from a fixed pool of worker threads at a lower CPU priority than the
+# tracker so the web interface can't starve it.
+
+import os
+import sys
+import socket
+from threading import Thread, BoundedSemaphore
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+from config import webconfig
+from trackertrace import trace
+
+# Request paths which stream for as long as the client is connected. Once
+# the request has been read by a worker these are handed to their own
+# thread, up to webconfig['streams'] at once, so they never hold a worker
+stream_paths = ['/live']
+
+class QuietRequestHandler(WSGIRequestHandler):
+    'Request handler which only logs errors and serves streams on their own thread'
+
+    # Seconds a client has to send its request, or to take each part of the
+    # response, so slow clients can't hold a worker
+    timeout = webconfig['request_timeout']
+
+    def setup(self):
+        WSGIRequestHandler.setup(self)
+        self.detached = False # Response is being sent from a stream thread
+
+    def handle(self):
+        # As WSGIRequestHandler.handle with streams handed to the server
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout: # Client never sent a request
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.parse_request(): # An error has been sent
+            return
+        if self.path.split('?', 1)[0] in stream_paths:
+            if not self.server.detach(self):
+                self.send_error(503, "Too many streams")
+            return
+        self.respond()
+
+    def respond(self):
+        handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self # For logging
+        handler.run(self.server.get_app())
+
+    def finish(self):
+        # A detached request is finished by its stream thread
+        if not self.detached:
+            WSGIRequestHandler.finish(self)
+
+    def log_request(self, *args):
+        pass
+
+class PooledWSGIServer(WSGIServer):
+    'WSGI server handing requests to a fixed pool of worker threads'
+
+    def __init__(self, address, handler, threads, streams):
+        WSGIServer.__init__(self, address, handler)
+        # Accepting blocks once every worker is busy and the queue is full
+        # so the number of requests being processed is limited. The accept
+        # thread never reads from a request
+        self.requests = Queue(threads)
+        self.streams = BoundedSemaphore(streams)
+        self.workers = []
+        for i in range(threads):
+            t = Thread(target=self.worker)
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def serve_request(self, request, client_address):
+        detached = False
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+            detached = handler.detached
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if not detached:
+                self.shutdown_request(request)
+
+    def detach(self, handler):
+        # Send the response to a read request on its own thread. Returns
+        # False if every stream slot is in use
+        if not self.streams.acquire(False):
+            return False
+        handler.detached = True
+        t = Thread(target=self.stream, args=(handler,))
+        t.daemon = True
+        t.start()
+        return True
+
+    def stream(self, handler):
+        try:
+            handler.respond()
+            WSGIRequestHandler.finish(handler)
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            self.shutdown_request(handler.request)
+            self.streams.release()
+
+    def worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            (request, client_address) = item
+            self.serve_request(request, client_address)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        for t in self.workers:
+            self.requests.put(None)
+
+def checkdebug(app):
+    # Debug mode allows code execution from the browser and reloads the app
+    # so must never be used when serving for real
+    if app.debug or webconfig['debug']:
+        raise RuntimeError("Debug mode is enabled, set webconfig['debug'] to False")
+
+def serve():
+    from web import app
+    checkdebug(app)
+
+    if webconfig['nice'] > 0:
+        os.nice(webconfig['nice'])
+
+    server = PooledWSGIServer((webconfig['interface'], webconfig['port']), QuietRequestHandler, webconfig['threads'], webconfig['streams'])
+    server.set_app(app)
+    trace.dumponsignal()
+    print ("Serving on {0}:{1} with {2} threads".format(webconfig['interface'], webconfig['port'], webconfig['threads']))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print ("Interrupt received, stopping web server")
+    finally:
+        server.server_close()
+
+# Main
+
+if __name__ == '__main__':
+    try:
+        serve()
+    except RuntimeError as e:
+        print ("Error: {0}".format(e))
+        sys.exit(1)